@@ -2,31 +2,75 @@ import os
 import re
 import threading
 import queue
+import multiprocessing
+import importlib.metadata
 import json
+import hashlib
 import warnings
 import logging
-import spacy
 import string
-import gender_guesser.detector as gender
+import bisect
+import emoji
+import numpy as np
 
-from langdetect import detect
-from typing import List, Any, Tuple
+from itertools import accumulate
+from langdetect import detect, DetectorFactory
+from typing import Dict, List, Any, Iterator, Tuple
 
 from setup import Config
-from helpers import GenderPredictorForPolishNames, Counter, encode, BannedWords
+from corpus import Corpus, EmojiIndex
+from helpers import (
+    GenderResolver,
+    Counter,
+    fix_encoding,
+    BannedWords,
+    TokensCache,
+)
+
+# langdetect is not deterministic unless seeded
+DetectorFactory.seed = 0
 
 
 class CleaningExecutor:
+    # shared bookkeeping - ids counters and stats
     LOCK = threading.Lock()
+    REGISTER_LOCK = threading.Lock()
+    # output files, tokens cache connection and langdetect have own locks, so
+    # threads do not wait on each other's lemmatization
+    WRITE_LOCK = threading.Lock()
+    CACHE_LOCK = threading.Lock()
+    DETECT_LOCK = threading.Lock()
     Q = queue.Queue()
 
     USERS = Counter(LOCK)
     TITLES = Counter(LOCK)
-    GENDER = gender.Detector(case_sensitive=False)
-    GENDER_POLISH = GenderPredictorForPolishNames()
-    LEMMATIZER_EN = spacy.load("en_core_web_sm")
-    LEMMATIZER_PL = spacy.load("pl_core_news_sm")
+    LOAD_LOCK = threading.Lock()
+    # only lemma_ and is_stop are read, so dependency parser and ner are not needed
+    LEMMATIZER_EXCLUDE = ["parser", "ner"]
+    LEMMATIZER_MODELS = {"pl": "pl_core_news_sm", "en": "en_core_web_sm"}
+
+    # heavy resources are loaded on first use (see get_lemmatizer, get_genders_resolver)
+    LEMMATIZERS = {}
+    # spaCy pipelines are not thread safe - each model is used by one thread at once
+    LEMMATIZER_LOCKS = {}
+    GENDERS = None
     TRANSLATION_TABLE = str.maketrans("", "", string.punctuation)
+    NOT_LETTERS = re.compile(r"[\W\d_]+")
+    # emojis are made of these characters only, tokens without them are skipped
+    EMOJI_CANDIDATES = re.compile("[\u00a9\u00ae\u203c-\U0010ffff]")
+    # characters joining or modifying emojis that tokenizer splits into own tokens -
+    # ZWJ, variation selector, keycap, skin tones, tags and flags' regional indicators
+    EMOJI_PARTS = re.compile(
+        "[\u200d\ufe0f\u20e3\U0001f3fb-\U0001f3ff\U000e0020-\U000e007f"
+        "\U0001f1e6-\U0001f1ff]"
+    )
+    STATS = {"messages": 0, "calls": 0, "cache_hits": 0, "cache_misses": 0}
+    CACHE = None
+    MANIFEST_OPTIONS = ("default_language", "language_min_length", "language_window")
+    CACHE_PID = None
+    # conversations written by this run - files left by an interrupted run are
+    # removed before first write, not appended to
+    WRITTEN = set()
 
     @staticmethod
     def get_file_path(path: str) -> str:
@@ -34,6 +78,24 @@ class CleaningExecutor:
             return os.path.join(Config.get("input_dir_path"), path)
         return path
 
+    @staticmethod
+    def get_input_dir_paths() -> List[str]:
+        """Export roots of comma separated --input_dir_path, each of them is one account."""
+        return [
+            os.path.abspath(path)
+            for path in Config.get("input_dir_path").split(",")
+            if path != ""
+        ]
+
+    @staticmethod
+    def get_account(path: str) -> int:
+        """Index of export root (in --input_dir_path) holding path."""
+        path = os.path.abspath(path)
+        for account, root in enumerate(CleaningExecutor.get_input_dir_paths()):
+            if os.path.commonpath([path, root]) == root:
+                return account
+        return 0
+
     @staticmethod
     def get_parent_directory(path: str) -> str:
         return os.path.basename(os.path.dirname(CleaningExecutor.get_file_path(path)))
@@ -46,7 +108,11 @@ class CleaningExecutor:
     @staticmethod
     def get_messages_folders(dirs: List[str] = None) -> List[str]:
         if dirs is None:
-            dirs = CleaningExecutor.get_folders(Config.get("input_dir_path"))
+            dirs = [
+                os.path.join(root, folder)
+                for root in CleaningExecutor.get_input_dir_paths()
+                for folder in CleaningExecutor.get_folders(root)
+            ]
 
         messages_dir = []
         for d in dirs:
@@ -58,18 +124,23 @@ class CleaningExecutor:
         return messages_dir
 
     @staticmethod
-    def get_json_message_files(path: str, prefix: str = "message_") -> List[str]:
+    def get_json_message_files(
+        path: str, prefix: str = "message_", extension: str = ".json"
+    ) -> List[str]:
         return [
             p
             for p in os.listdir(CleaningExecutor.get_file_path(path))
-            if os.path.splitext(p)[-1] == ".json"
+            if os.path.splitext(p)[-1] == extension
             # and not os.path.basename(p).startswith(".")
             and os.path.basename(p).startswith(prefix)
         ]
 
     @staticmethod
     def get_messages_files(
-        dirs: List[str] = None, dir: str = None, prefix: str = "message_"
+        dirs: List[str] = None,
+        dir: str = None,
+        prefix: str = "message_",
+        extension: str = ".json",
     ) -> None:
         """Saves json message files absolute paths to Q"""
         assert not (
@@ -84,7 +155,7 @@ class CleaningExecutor:
         def walk_(path: str) -> None:
             path = CleaningExecutor.get_file_path(path)
 
-            for f in CleaningExecutor.get_json_message_files(path, prefix):
+            for f in CleaningExecutor.get_json_message_files(path, prefix, extension):
                 CleaningExecutor.Q.put(os.path.join(path, f))
             for dir in CleaningExecutor.get_folders(path):
                 walk_(os.path.join(path, dir))
@@ -93,39 +164,67 @@ class CleaningExecutor:
             walk_(dir)
 
     @staticmethod
-    def read_json(path: str) -> Any:
+    def get_output_path(path: str) -> str:
+        if not os.path.isabs(path):
+            return os.path.join(Config.get("output_dir_path"), path)
+        return path
+
+    @staticmethod
+    def read_json(path: str, fix_mojibake: bool = False) -> Any:
+        """With fix_mojibake strings of messenger export are decoded while parsing."""
         path = CleaningExecutor.get_file_path(path)
         with open(path, "r", encoding="utf-8") as file:
-            return json.load(file)
+            return json.load(file, object_hook=fix_encoding if fix_mojibake else None)
 
     @staticmethod
-    def save_json(data: Any, path: str) -> None:
-        if not os.path.isabs(path):
-            path = os.path.join(Config.get("output_dir_path"), path)
+    def save_json(data: Any, path: str, extend: bool = True) -> None:
+        path = CleaningExecutor.get_output_path(path)
         os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        if os.path.exists(path):
-            logging.info(f"Extending {path}")
-            with CleaningExecutor.LOCK:
+        with CleaningExecutor.WRITE_LOCK:
+            if extend and os.path.exists(path):
+                logging.info(f"Extending {path}")
                 dt = CleaningExecutor.read_json(path)
                 data.extend(dt)
 
-        with CleaningExecutor.LOCK:
             with open(path, "w") as file:
                 return json.dump(data, file, ensure_ascii=False)
 
+    @staticmethod
+    def append_jsonl(files: Dict[str, List[Any]]) -> None:
+        """
+        Appends entries of data to json lines file of each path - all files under one
+        lock, so their parts stay in the same order. Existing content is never read.
+        """
+        lines = {
+            CleaningExecutor.get_output_path(path): "".join(
+                json.dumps(entry, ensure_ascii=False) + "\n" for entry in data
+            )
+            for path, data in files.items()
+        }
+        for path in lines:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with CleaningExecutor.WRITE_LOCK:
+            for path, content in lines.items():
+                with open(path, "a", encoding="utf-8") as file:
+                    file.write(content)
+
+    @staticmethod
+    def get_genders_resolver() -> GenderResolver:
+        if CleaningExecutor.GENDERS is None:
+            with CleaningExecutor.LOAD_LOCK:
+                if CleaningExecutor.GENDERS is None:
+                    CleaningExecutor.GENDERS = GenderResolver()
+        return CleaningExecutor.GENDERS
+
     @staticmethod
     def get_gender(name: str) -> str:
-        with CleaningExecutor.LOCK:
-            gender = CleaningExecutor.GENDER_POLISH.predict_gender(name)
-            if gender == "unknown":
-                gender = CleaningExecutor.GENDER.get_gender(name)
-                if gender == "mostly_male":
-                    return "male"
-                elif gender == "mostly_female":
-                    return "female"
+        return CleaningExecutor.get_genders_resolver().get_gender(name)
 
-            return gender
+    @staticmethod
+    def get_genders(names: List[str]) -> List[str]:
+        return CleaningExecutor.get_genders_resolver().get_genders(names)
 
     @staticmethod
     def get_participant_key(name: str, map: dict = None, warn: bool = False) -> Any:
@@ -153,7 +252,7 @@ class CleaningExecutor:
     def encode_participants(participants: List[dict]) -> dict:
         participants_map = {}
         for participant in participants:
-            name = encode(participant.get("name", "unknown"))[0]
+            name = participant.get("name", "unknown")
             if name == "unknown":
                 warnings.warn(f"Unknown participant.")
 
@@ -164,14 +263,63 @@ class CleaningExecutor:
 
     @staticmethod
     def detect_language(message):
-        try:
-            language = detect(message)
-            return language
-        except Exception as e:
+        if message.strip() == "":
             return Config.get("default_language")
 
+        with CleaningExecutor.LOCK:
+            CleaningExecutor.STATS["calls"] += 1
+
+        # langdetect lazily loads its shared profiles, which is not thread safe
+        with CleaningExecutor.DETECT_LOCK:
+            try:
+                language = detect(message)
+                return language
+            except Exception as e:
+                return Config.get("default_language")
+
     @staticmethod
-    def clean_content(message: str) -> List[str]:
+    def is_informative(message: str) -> bool:
+        letters = CleaningExecutor.NOT_LETTERS.sub("", message)
+        return len(letters) >= Config.get("language_min_length")
+
+    @staticmethod
+    def detect_languages(messages: List[str]) -> List[str]:
+        """
+        Detects language once for all messages of a conversation (and once per each
+        --language_window messages if set), short messages inherit that language.
+        """
+        with CleaningExecutor.LOCK:
+            CleaningExecutor.STATS["messages"] += len(messages)
+
+        informative = [
+            message if CleaningExecutor.is_informative(message) else ""
+            for message in messages
+        ]
+        language = CleaningExecutor.detect_language(" ".join(informative))
+        languages = [language] * len(messages)
+
+        window = Config.get("language_window")
+        if window > 0 and len(messages) > window:
+            for start in range(0, len(messages), window):
+                text = " ".join(informative[start : start + window])
+                if text.strip() != "":
+                    window_language = CleaningExecutor.detect_language(text)
+                    languages[start : start + window] = [window_language] * len(
+                        languages[start : start + window]
+                    )
+
+        return languages
+
+    @staticmethod
+    def pop_stats() -> dict:
+        with CleaningExecutor.LOCK:
+            stats = dict(CleaningExecutor.STATS)
+            for key in CleaningExecutor.STATS.keys():
+                CleaningExecutor.STATS[key] = 0
+        return stats
+
+    @staticmethod
+    def normalize_content(message: str) -> str:
         message = message.lower()
         message = re.sub(
             r"https?://\S+|www\.\S+",
@@ -179,72 +327,678 @@ class CleaningExecutor:
             message,
         )
 
-        message = message.translate(CleaningExecutor.TRANSLATION_TABLE)
+        return message.translate(CleaningExecutor.TRANSLATION_TABLE)
+
+    @staticmethod
+    def normalize_contents(contents: List[str]) -> List[str]:
+        """Same as normalize_content for each of contents, done in one pass over all."""
+        # separator starts with whitespace, so links regex can not swallow it
+        separator = " \x1e"
+        if len(contents) == 0 or any("\x1e" in content for content in contents):
+            return [CleaningExecutor.normalize_content(c) for c in contents]
 
-        language = CleaningExecutor.detect_language(message)
+        joined = CleaningExecutor.normalize_content(separator.join(contents))
+        return joined.split(separator)
+
+    @staticmethod
+    def get_lemmatizer_model(language: str) -> str:
         if language == "pl":
-            with CleaningExecutor.LOCK:
-                doc = CleaningExecutor.LEMMATIZER_PL(message)
-        else:
-            with CleaningExecutor.LOCK:
-                doc = CleaningExecutor.LEMMATIZER_EN(message)
-        tokens = [token.lemma_ for token in doc if not token.is_stop]
+            return CleaningExecutor.LEMMATIZER_MODELS["pl"]
+        return CleaningExecutor.LEMMATIZER_MODELS["en"]
+
+    @staticmethod
+    def get_lemmatizer(language: str) -> Any:
+        model = CleaningExecutor.get_lemmatizer_model(language)
+        if model not in CleaningExecutor.LEMMATIZERS:
+            with CleaningExecutor.LOAD_LOCK:
+                if model not in CleaningExecutor.LEMMATIZERS:
+                    import spacy
+
+                    logging.info(f"Loading {model}")
+                    CleaningExecutor.LEMMATIZER_LOCKS[model] = threading.Lock()
+                    CleaningExecutor.LEMMATIZERS[model] = spacy.load(
+                        model, exclude=CleaningExecutor.LEMMATIZER_EXCLUDE
+                    )
+        return CleaningExecutor.LEMMATIZERS[model]
 
+    @staticmethod
+    def get_tokens(doc: Any) -> List[str]:
+        tokens = [token.lemma_ for token in doc if not token.is_stop]
         return [token.strip() for token in tokens if token.strip() != ""]
 
+    @staticmethod
+    def lemmatize(messages: List[str], language: str) -> List[List[str]]:
+        """Lemmatizes already normalized messages of one language in batches."""
+        lemmatizer = CleaningExecutor.get_lemmatizer(language)
+        model = CleaningExecutor.get_lemmatizer_model(language)
+        with CleaningExecutor.LEMMATIZER_LOCKS[model]:
+            return [
+                CleaningExecutor.get_tokens(doc)
+                for doc in lemmatizer.pipe(
+                    messages, batch_size=Config.get("batch_size")
+                )
+            ]
+
+    @staticmethod
+    def get_cache_path() -> str:
+        return os.path.join(Config.get("output_dir_path"), "tokens_cache.sqlite")
+
+    @staticmethod
+    def get_cache() -> TokensCache | None:
+        """Returns tokens cache opened by current process, None if it is disabled."""
+        if Config.get("cache_size") <= 0:
+            return None
+
+        # sqlite connections must not be shared with forked workers
+        if CleaningExecutor.CACHE_PID != os.getpid():
+            CleaningExecutor.CACHE = TokensCache(
+                CleaningExecutor.get_cache_path(), Config.get("cache_size")
+            )
+            CleaningExecutor.CACHE_PID = os.getpid()
+        return CleaningExecutor.CACHE
+
+    @staticmethod
+    def get_model_version(language: str) -> str:
+        # read from packages metadata, so cache hits do not need to load the model
+        model = CleaningExecutor.get_lemmatizer_model(language)
+        try:
+            version = importlib.metadata.version(model)
+        except importlib.metadata.PackageNotFoundError:
+            version = CleaningExecutor.get_lemmatizer(language).meta["version"]
+        return f"{model}-{version}@spacy-{importlib.metadata.version('spacy')}"
+
+    @staticmethod
+    def lemmatize_cached(messages: List[str], language: str) -> List[List[str]]:
+        """Same as lemmatize, but reuses tokens cached by previous runs."""
+        cache = CleaningExecutor.get_cache()
+        if cache is None:
+            return CleaningExecutor.lemmatize(messages, language)
+
+        model = CleaningExecutor.get_model_version(language)
+        keys = [TokensCache.get_key(message, language, model) for message in messages]
+        with CleaningExecutor.CACHE_LOCK:
+            hits, misses = cache.hits, cache.misses
+            found = cache.get_many(keys)
+            hits, misses = cache.hits - hits, cache.misses - misses
+        with CleaningExecutor.LOCK:
+            CleaningExecutor.STATS["cache_hits"] += hits
+            CleaningExecutor.STATS["cache_misses"] += misses
+
+        missing = {}
+        for key, message in zip(keys, messages):
+            if key not in found:
+                missing[key] = message
+        lemmatized = dict(
+            zip(
+                missing.keys(),
+                CleaningExecutor.lemmatize(list(missing.values()), language),
+            )
+        )
+        if len(lemmatized) > 0:
+            with CleaningExecutor.CACHE_LOCK:
+                cache.set_many(lemmatized)
+
+        found.update(lemmatized)
+        return [found[key] for key in keys]
+
+    @staticmethod
+    def clean_content(message: str) -> List[str]:
+        message = CleaningExecutor.normalize_content(message)
+        language = CleaningExecutor.detect_languages([message])[0]
+        return CleaningExecutor.lemmatize([message], language)[0]
+
+    @staticmethod
+    def clean_contents(contents: List[str]) -> List[List[str]]:
+        """
+        Same as clean_content for each of contents, but messages are grouped
+        by language and lemmatized with one nlp.pipe call per language.
+        """
+        res = [None] * len(contents)
+        contents = CleaningExecutor.normalize_contents(contents)
+        languages = CleaningExecutor.detect_languages(contents)
+
+        batches = {}
+        for i, (content, language) in enumerate(zip(contents, languages)):
+            batches.setdefault(language, ([], []))
+            batches[language][0].append(i)
+            batches[language][1].append(content)
+
+        for language, (indexes, batch) in batches.items():
+            for i, tokens in zip(
+                indexes, CleaningExecutor.lemmatize_cached(batch, language)
+            ):
+                res[i] = tokens
+        return res
+
+    @staticmethod
+    def clean_messages(messages: List[dict]) -> List[Tuple[str, Any, int]]:
+        """Cleans messages contents, senders are left as names."""
+        contents = [message.get("content", "") for message in messages]
+        not_banned = [
+            i
+            for i, content in enumerate(contents)
+            if not BannedWords.is_banned(content)
+        ]
+        cleaned = CleaningExecutor.clean_contents([contents[i] for i in not_banned])
+
+        res = ["MetaCommand"] * len(messages)
+        for i, tokens in zip(not_banned, cleaned):
+            res[i] = tokens
+
+        return [
+            (
+                message.get("sender_name", ""),
+                content,
+                message.get("timestamp_ms", None),
+            )
+            for message, content in zip(messages, res)
+        ]
+
     @staticmethod
     def encode_messages(
         messages: List[dict], participants_map: dict
     ) -> List[Tuple[int, str]]:
+        return CleaningExecutor.encode_senders(
+            CleaningExecutor.clean_messages(messages), participants_map
+        )
+
+    @staticmethod
+    def encode_senders(
+        messages: List[Tuple[str, Any, int]], participants_map: dict
+    ) -> List[Tuple[int, Any, int]]:
         res = [None] * len(messages)
-        for i, message in enumerate(messages):
+        for i, (sender_name, content, timestamp) in enumerate(messages):
             key, participants_map = CleaningExecutor.get_participant_key(
-                encode(message.get("sender_name", ""))[0], participants_map, warn=True
-            )
-
-            content = message.get("content", "")
-            res[i] = (
-                key,
-                CleaningExecutor.clean_content(encode(content)[0])
-                if not BannedWords.is_banned(content)
-                else "MetaCommand",
-                message.get("timestamp_ms", None),
+                sender_name, participants_map, warn=True
             )
+            res[i] = (key, content, timestamp)
         return res
 
     @staticmethod
-    def encode_json_file(path: str) -> None:
+    def is_emoji_token(token: str) -> bool:
+        rest = CleaningExecutor.EMOJI_PARTS.sub("", token)
+        return token != "" and (rest == "" or emoji.purely_emoji(rest))
+
+    @staticmethod
+    def get_message_emojis(tokens: List[str]) -> List[list]:
+        """
+        Finds emojis in message tokens, returns (position, span, emoji) entries.
+        Tokenizer splits ZWJ, skin tone, flag and keycap sequences, so consecutive
+        emoji tokens are joined back - such emoji spans all tokens it is made of.
+        """
+        emojis = []
+        j = 0
+        while j < len(tokens):
+            if not CleaningExecutor.EMOJI_CANDIDATES.search(tokens[j]):
+                j += 1
+                continue
+
+            k = j
+            while k < len(tokens) and CleaningExecutor.is_emoji_token(tokens[k]):
+                k += 1
+            if k == j:  # emoji glued to a word
+                emojis.extend([j, 1, e["emoji"]] for e in emoji.emoji_list(tokens[j]))
+                j += 1
+                continue
+
+            ends = list(accumulate(len(token) for token in tokens[j:k]))
+            for e in emoji.emoji_list("".join(tokens[j:k])):
+                first = bisect.bisect_right(ends, e["match_start"])
+                last = bisect.bisect_left(ends, e["match_end"])
+                emojis.append([j + first, last - first + 1, e["emoji"]])
+            j = k
+        return emojis
+
+    @staticmethod
+    def get_emojis(messages: List[tuple]) -> List[list]:
+        """Returns (message index, position, span, emoji) entries of cleaned messages."""
+        return [
+            [i, *e]
+            for i, message in enumerate(messages)
+            if isinstance(message[-2], list)
+            for e in CleaningExecutor.get_message_emojis(message[-2])
+        ]
+
+    @staticmethod
+    def read_json_file(path: str) -> Tuple[str, List[dict], List[dict]] | None:
+        """
+        Reads single message_*.json file, returns (unique_title, participants,
+        messages) or None if file should be skipped.
+        """
         path = CleaningExecutor.get_file_path(path)
-        data = CleaningExecutor.read_json(path)
+        data = CleaningExecutor.read_json(path, fix_mojibake=True)
         assert isinstance(data, dict), f"{path}: read data is {type(data)}"
 
-        title = encode(data.pop("title", ""))[0]
+        title = data.pop("title", "")
         if title == "":
             warnings.warn(f"File {path} has no title")
-            return
+            return None
         unique_title = CleaningExecutor.get_parent_directory(path) + "___" + title
-        key = CleaningExecutor.TITLES.get(unique_title)
-        if key is None:
-            key = CleaningExecutor.TITLES.get_id()
-            CleaningExecutor.TITLES.set(unique_title, key)
 
         participants = data.pop("participants", {})
         if participants == {}:
             warnings.warn(f"File {path} has no participants")
-            return
-        participants_map = CleaningExecutor.encode_participants(participants)
+            return None
 
         messages = data.pop("messages", {})
         if messages == {}:
             warnings.warn(f"File {path} has no messages")
-            return
-        messages = CleaningExecutor.encode_messages(messages, participants_map)
+            return None
+        return unique_title, participants, messages
+
+    @staticmethod
+    def clean_json_file(path: str) -> Tuple[str, List[dict], list, list] | None:
+        """
+        Reads and cleans single message_*.json file without touching USERS and TITLES,
+        returns (unique_title, participants, messages, emojis) or None if file should
+        be skipped.
+        """
+        read = CleaningExecutor.read_json_file(path)
+        if read is None:
+            return None
+
+        unique_title, participants, messages = read
+        messages = CleaningExecutor.clean_messages(messages)
+        return (
+            unique_title,
+            participants,
+            messages,
+            CleaningExecutor.get_emojis(messages),
+        )
+
+    @staticmethod
+    def clean_conversation_files(paths: List[str]) -> List[tuple]:
+        """
+        Cleans all parts of a single conversation, found in one or several exports,
+        returns (unique_title, participants, messages, emojis, accounts) of each part -
+        accounts are bitmasks of exports each message was found in. Parts are
+        registered under title of the first one. Messages already read from another
+        export are dropped before cleaning, so each of them is lemmatized once.
+        """
+        several = len({CleaningExecutor.get_account(path) for path in paths}) > 1
+        parts, seen = [], {}
+        for path in paths:
+            read = CleaningExecutor.read_json_file(path)
+            if read is None:
+                continue
+
+            unique_title, participants, messages = read
+            account = CleaningExecutor.get_account(path)
+            kept, accounts = [], []
+            for message in messages:
+                key = (
+                    message.get("sender_name", ""),
+                    message.get("timestamp_ms", None),
+                    message.get("content", ""),
+                )
+                first = seen.get(key) if several else None
+                if first is not None and first[0] != account:
+                    parts[first[1]][4][first[2]] |= 1 << account
+                    continue
+                if several:
+                    seen.setdefault(key, (account, len(parts), len(kept)))
+                kept.append(message)
+                accounts.append(1 << account)
 
-        new_path = f"conversation_{key}.json"
+            if len(kept) > 0:
+                parts.append([unique_title, participants, kept, None, accounts])
 
-        CleaningExecutor.save_json(messages, new_path)
+        for part in parts:
+            part[0] = parts[0][0]
+            part[2] = CleaningExecutor.clean_messages(part[2])
+            part[3] = CleaningExecutor.get_emojis(part[2])
+        return [tuple(part) for part in parts]
+
+    @staticmethod
+    def register_conversation(
+        unique_title: str,
+        participants: List[dict],
+        messages: list,
+        emojis: list,
+        accounts: List[int] = None,
+    ) -> None:
+        """Assigns conversation and users ids to cleaned file and saves it."""
+        if accounts is None:
+            accounts = [1] * len(messages)
+
+        # ids lookup and creation must be atomic when cleaning with threads
+        with CleaningExecutor.REGISTER_LOCK:
+            key = CleaningExecutor.TITLES.get(unique_title)
+            if key is None:
+                key = CleaningExecutor.TITLES.get_id()
+                CleaningExecutor.TITLES.set(unique_title, key)
+
+            participants_map = CleaningExecutor.encode_participants(participants)
+            messages = CleaningExecutor.encode_senders(messages, participants_map)
+            # all parts of a conversation are registered by one worker, in order
+            first_part = key not in CleaningExecutor.WRITTEN
+            CleaningExecutor.WRITTEN.add(key)
+
+        if first_part:
+            CleaningExecutor.remove_conversation_files([key])
+
+        # emoji file gets one (number of messages, emojis) line per appended part,
+        # account file one line of accounts of its messages
+        CleaningExecutor.append_jsonl(
+            {
+                f"conversation_{key}.jsonl": messages,
+                f"emoji_{key}.jsonl": [[len(messages), emojis]],
+                f"account_{key}.jsonl": [accounts],
+            }
+        )
         logging.info(f"Encoded {unique_title}")
 
+    @staticmethod
+    def encode_conversation_files(paths: List[str]) -> None:
+        for cleaned in CleaningExecutor.clean_conversation_files(paths):
+            CleaningExecutor.register_conversation(*cleaned)
+
+    @staticmethod
+    def clean_conversation(paths: List[str]) -> Tuple[List[tuple], dict]:
+        """
+        Process pool worker - cleans all parts of a single conversation, returns
+        them together with worker's language detection stats.
+        """
+        return (
+            CleaningExecutor.clean_conversation_files(paths),
+            CleaningExecutor.pop_stats(),
+        )
+
+    @staticmethod
+    def init_worker(config: dict) -> None:
+        Config.set(**config)
+        if Config.get("verbose") == 1:
+            warnings.simplefilter("ignore")
+
+    @staticmethod
+    def get_conversations_files() -> List[List[str]]:
+        """
+        Groups json message files found by get_messages_files by conversation
+        directory (directories of the same conversation in several exports together),
+        largest conversations first so pool workers stay busy.
+        """
+        CleaningExecutor.get_messages_files()
+
+        conversations = {}
+        while True:
+            try:
+                path = CleaningExecutor.Q.get_nowait()
+                conversations.setdefault(os.path.dirname(path), []).append(path)
+            except queue.Empty:
+                break
+
+        conversations = [sorted(paths) for paths in conversations.values()]
+        if len(CleaningExecutor.get_input_dir_paths()) > 1:
+            conversations = CleaningExecutor.join_exports(conversations)
+        return sorted(
+            conversations,
+            key=lambda paths: -sum(os.path.getsize(p) for p in paths),
+        )
+
+    @staticmethod
+    def get_conversation_identity(path: str) -> tuple:
+        """
+        Key of conversation that is the same in each export it is found in - names of
+        participants and title of groups (title of private conversation is name of
+        the other participant, so it differs between exports).
+        """
+        data = CleaningExecutor.read_json(path, fix_mojibake=True)
+        names = sorted(p.get("name", "unknown") for p in data.get("participants", []))
+        return (*names, data.get("title", "") if len(names) > 2 else "")
+
+    @staticmethod
+    def join_exports(conversations: List[List[str]]) -> List[List[str]]:
+        """
+        Joins files of conversation directories with the same identity from different
+        exports (in order of accounts) - k-th such directory of each export is taken
+        as the same conversation.
+        """
+        joined = {}
+        for paths in sorted(
+            conversations,
+            key=lambda paths: (CleaningExecutor.get_account(paths[0]), paths[0]),
+        ):
+            account = CleaningExecutor.get_account(paths[0])
+            same = joined.setdefault(
+                CleaningExecutor.get_conversation_identity(paths[0]), []
+            )
+            for exports in same:
+                if account not in exports:
+                    exports[account] = paths
+                    break
+            else:
+                same.append({account: paths})
+
+        return [
+            [path for account in sorted(exports) for path in exports[account]]
+            for same in joined.values()
+            for exports in same
+        ]
+
+    @staticmethod
+    def get_manifest_key(path: str) -> str:
+        """
+        Directory of file relative to its export root, prefixed with index of the
+        account if there are several exports.
+        """
+        account = CleaningExecutor.get_account(path)
+        roots = CleaningExecutor.get_input_dir_paths()
+        key = os.path.relpath(os.path.dirname(path), roots[account])
+        return key if len(roots) == 1 else f"{account}:{key}"
+
+    @staticmethod
+    def get_manifest_path() -> str:
+        return CleaningExecutor.get_output_path(
+            Config.get("prefix") + "_" + "manifest.json"
+        )
+
+    @staticmethod
+    def get_manifest_options() -> dict:
+        """Options that change cleaned output - if they differ all files are cleaned again."""
+        options = {name: Config.get(name) for name in CleaningExecutor.MANIFEST_OPTIONS}
+        # accounts of several exports are their indexes in --input_dir_path
+        roots = CleaningExecutor.get_input_dir_paths()
+        if len(roots) > 1:
+            options["input_dir_path"] = roots
+        return options
+
+    @staticmethod
+    def get_file_signature(path: str, previous: dict = None) -> dict:
+        stat = os.stat(path)
+        signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+        # hashing is skipped for files that were not touched since last run
+        if (
+            previous is not None
+            and previous["size"] == signature["size"]
+            and previous["mtime"] == signature["mtime"]
+        ):
+            signature["hash"] = previous["hash"]
+        else:
+            file_hash = hashlib.blake2b()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    file_hash.update(chunk)
+            signature["hash"] = file_hash.hexdigest()
+
+        return signature
+
+    @staticmethod
+    def get_output_conversation_files() -> List[str]:
+        """Conversation, emoji and account files with current prefix in output directory."""
+        output_dir = Config.get("output_dir_path")
+        if not os.path.isdir(output_dir):
+            return []
+        return [
+            os.path.join(output_dir, p)
+            for prefix in ("conversation_", "emoji_", "account_")
+            for p in CleaningExecutor.get_json_message_files(
+                output_dir, prefix + Config.get("prefix") + "_", ".jsonl"
+            )
+        ]
+
+    @staticmethod
+    def remove_conversation_files(conversation_ids: List[str] = None) -> None:
+        """Removes outputs of given conversations (by default all with current prefix)."""
+        if conversation_ids is None:
+            paths = CleaningExecutor.get_output_conversation_files()
+        else:
+            paths = [
+                CleaningExecutor.get_output_path(f"{name}_{key}.jsonl")
+                for key in conversation_ids
+                for name in ("conversation", "emoji", "account")
+            ]
+
+        for path in paths:
+            if os.path.exists(path):
+                logging.info(f"Removing {path}")
+                os.remove(path)
+
+    @staticmethod
+    def load_manifest() -> dict:
+        """
+        Returns conversations manifest of previous run and restores its users and
+        titles ids. Without valid manifest previous outputs are removed.
+        """
+        path = CleaningExecutor.get_manifest_path()
+        try:
+            manifest = CleaningExecutor.read_json(path) if os.path.exists(path) else {}
+        except (OSError, ValueError) as e:
+            logging.info(f"Could not read manifest ({e}), all files will be cleaned")
+            manifest = {}
+
+        if manifest.get("options") != CleaningExecutor.get_manifest_options():
+            if len(manifest) > 0:
+                logging.info("Cleaning options changed, all files will be cleaned")
+            CleaningExecutor.remove_conversation_files()
+            return {}
+
+        # manifest is valid only together with users and titles ids of its run
+        prefix = Config.get("prefix") + "_"
+        try:
+            users = CleaningExecutor.read_json(
+                CleaningExecutor.get_output_path(prefix + "users.json")
+            )
+            titles = CleaningExecutor.read_json(
+                CleaningExecutor.get_output_path(prefix + "titles.json")
+            )
+        except (OSError, ValueError) as e:
+            logging.info(
+                f"Could not restore ids of previous run ({e}), all files will be cleaned"
+            )
+            CleaningExecutor.remove_conversation_files()
+            return {}
+        CleaningExecutor.USERS.load(users, get_id=lambda value: value[0])
+        CleaningExecutor.TITLES.load(titles)
+
+        # files of ids that were not saved, written by an interrupted run
+        keys = set(CleaningExecutor.TITLES.dt.values())
+        CleaningExecutor.remove_conversation_files(
+            sorted(
+                {
+                    os.path.splitext(os.path.basename(path))[0].split("_", 1)[1]
+                    for path in CleaningExecutor.get_output_conversation_files()
+                }
+                - keys
+            )
+        )
+        return manifest["conversations"]
+
+    @staticmethod
+    def get_changed_conversations(
+        conversations: List[List[str]], manifest: dict
+    ) -> Tuple[List[List[str]], dict]:
+        """
+        Returns conversations that are new or changed since run described by manifest
+        (their old outputs are removed) and manifest of current input.
+        """
+        new_manifest = {}
+        changed = [False] * len(conversations)
+        previous_ids = [set() for _ in conversations]
+        for i, paths in enumerate(conversations):
+            directories = {}
+            for path in paths:
+                directories.setdefault(
+                    CleaningExecutor.get_manifest_key(path), []
+                ).append(path)
+
+            for directory, files in directories.items():
+                previous = manifest.get(
+                    directory, {"files": {}, "conversation_id": None}
+                )
+                signatures = {
+                    os.path.basename(path): CleaningExecutor.get_file_signature(
+                        path, previous["files"].get(os.path.basename(path))
+                    )
+                    for path in files
+                }
+                new_manifest[directory] = {
+                    "files": signatures,
+                    "conversation_id": previous["conversation_id"],
+                }
+                previous_ids[i].add(previous["conversation_id"])
+
+                if {name: f["hash"] for name, f in signatures.items()} != {
+                    name: f["hash"] for name, f in previous["files"].items()
+                }:
+                    changed[i] = True
+            # directories of one conversation must have had one id
+            changed[i] |= len(previous_ids[i]) > 1
+
+        # conversations sharing outputs with changed ones are cleaned again too
+        removed = set()
+        while True:
+            ids = set().union(*(ids for c, ids in zip(changed, previous_ids) if c))
+            ids.discard(None)
+            if ids == removed:
+                break
+            removed = ids
+            changed = [
+                c or not removed.isdisjoint(i) for c, i in zip(changed, previous_ids)
+            ]
+        CleaningExecutor.remove_conversation_files(list(removed))
+
+        # conversations missing in current input keep their outputs
+        for directory, entry in manifest.items():
+            new_manifest.setdefault(directory, entry)
+
+        changed = [paths for c, paths in zip(changed, conversations) if c]
+        logging.info(
+            f"{len(changed)} of {len(conversations)} conversations are new or changed"
+        )
+        return changed, new_manifest
+
+    @staticmethod
+    def save_manifest(manifest: dict, changed: List[List[str]]) -> None:
+        # unique titles are "<conversation directory>___<title>"
+        titles = {
+            title.split("___", 1)[0]: key
+            for title, key in CleaningExecutor.TITLES.dt.items()
+        }
+        for paths in changed:
+            # parts of all exports are registered under title of the first one
+            conversation_id = next(
+                (
+                    titles[CleaningExecutor.get_parent_directory(path)]
+                    for path in paths
+                    if CleaningExecutor.get_parent_directory(path) in titles
+                ),
+                None,
+            )
+            for path in paths:
+                manifest[CleaningExecutor.get_manifest_key(path)][
+                    "conversation_id"
+                ] = conversation_id
+
+        CleaningExecutor.save_json(
+            {
+                "options": CleaningExecutor.get_manifest_options(),
+                "conversations": manifest,
+            },
+            CleaningExecutor.get_manifest_path(),
+            extend=False,
+        )
+
     @staticmethod
     def reverse(dt: dict, has_list: bool = False) -> dict:
         if has_list:
@@ -252,40 +1006,155 @@ class CleaningExecutor:
         return {v: k for k, v in dt.items()}
 
     @staticmethod
-    def get_processed_messages(messages: list, path: str) -> list:
-        conversation_id = os.path.splitext(os.path.basename(path))[0].lstrip(
-            "conversation_"
-        )
-        return [[conversation_id, *message] for message in messages]
+    def get_conversation_id(path: str) -> str:
+        return os.path.splitext(os.path.basename(path))[0][len("conversation_") :]
+
+    @staticmethod
+    def get_conversation_file_prefix() -> str:
+        return "conversation_" + Config.get("prefix") + "_"
 
     @staticmethod
-    def join_message_files():
+    def get_conversation_files() -> List[str]:
+        """Returns cleaned conversation files with current prefix."""
         CleaningExecutor.get_messages_files(
-            dir=Config.get("output_dir_path"), prefix="conversation_"
+            dir=Config.get("output_dir_path"),
+            prefix=CleaningExecutor.get_conversation_file_prefix(),
+            extension=".jsonl",
         )
 
-        messages = []
+        paths = []
         while True:
             try:
-                path = CleaningExecutor.Q.get_nowait()
-                dt = CleaningExecutor.read_json(path)
-                messages.extend(CleaningExecutor.get_processed_messages(dt, path))
+                paths.append(CleaningExecutor.Q.get_nowait())
             except queue.Empty:
                 break
-        return messages
+        return paths
+
+    @staticmethod
+    def get_emoji_file_path(conversation_path: str) -> str:
+        return os.path.join(
+            os.path.dirname(conversation_path),
+            "emoji_" + os.path.basename(conversation_path)[len("conversation_") :],
+        )
+
+    @staticmethod
+    def join_message_files(path: str, paths: List[str] = None) -> None:
+        """
+        Merges conversation files into one json list of (title_id, *message) entries,
+        streaming it line by line, so whole corpus is never held in memory.
+        """
+        if paths is None:
+            paths = CleaningExecutor.get_conversation_files()
+
+        path = CleaningExecutor.get_output_path(path)
+        with open(path, "w", encoding="utf-8") as output:
+            output.write("[")
+            separator = ""
+            for conversation_path in paths:
+                conversation_id = json.dumps(
+                    CleaningExecutor.get_conversation_id(conversation_path)
+                )
+                with open(conversation_path, "r", encoding="utf-8") as file:
+                    for line in file:
+                        # each line is a json list - just prepend conversation id
+                        output.write(
+                            f"{separator}[{conversation_id}, {line.rstrip()[1:]}"
+                        )
+                        separator = ", "
+            output.write("]")
+
+    @staticmethod
+    def iter_processed_messages(paths: List[str] = None) -> Iterator[list]:
+        """Yields (title_id, *message) entries of all conversation files."""
+        if paths is None:
+            paths = CleaningExecutor.get_conversation_files()
+
+        for conversation_path in paths:
+            conversation_id = CleaningExecutor.get_conversation_id(conversation_path)
+            with open(conversation_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    yield [conversation_id, *json.loads(line)]
+
+    @staticmethod
+    def get_groups(paths: List[str]) -> dict:
+        """Same as Query.get_groups of corpus joined from conversation files."""
+        groups = {}
+        for conversation_path in paths:
+            with open(conversation_path, "r", encoding="utf-8") as file:
+                users = {json.loads(line)[0] for line in file}
+            groups[CleaningExecutor.get_conversation_id(conversation_path)] = sorted(
+                users
+            )
+        return groups
+
+    @staticmethod
+    def get_account_file_path(conversation_path: str) -> str:
+        return os.path.join(
+            os.path.dirname(conversation_path),
+            "account_" + os.path.basename(conversation_path)[len("conversation_") :],
+        )
+
+    @staticmethod
+    def iter_accounts(paths: List[str]) -> Iterator[int]:
+        """
+        Yields accounts bitmask of each message of given conversation files, in order
+        of corpus joined from them.
+        """
+        for conversation_path in paths:
+            account_path = CleaningExecutor.get_account_file_path(conversation_path)
+            if not os.path.exists(account_path):
+                # conversation cleaned before account files were written
+                with open(conversation_path, "r", encoding="utf-8") as file:
+                    yield from (1 for _ in file)
+                continue
+
+            with open(account_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    yield from json.loads(line)
+
+    @staticmethod
+    def iter_emojis(paths: List[str]) -> Iterator[tuple]:
+        """
+        Yields (message, position, span, emoji) entries of emoji files of given
+        conversation files, message is index of entry in corpus joined from them.
+        """
+        offset = 0
+        for conversation_path in paths:
+            emoji_path = CleaningExecutor.get_emoji_file_path(conversation_path)
+            if not os.path.exists(emoji_path):
+                # conversation cleaned before emoji files were written
+                with open(conversation_path, "r", encoding="utf-8") as file:
+                    messages = [json.loads(line) for line in file]
+                with open(emoji_path, "w", encoding="utf-8") as file:
+                    file.write(
+                        json.dumps(
+                            [len(messages), CleaningExecutor.get_emojis(messages)],
+                            ensure_ascii=False,
+                        )
+                        + "\n"
+                    )
+
+            with open(emoji_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    n, emojis = json.loads(line)
+                    for i, position, span, e in emojis:
+                        yield offset + i, position, span, e
+                    offset += n
 
     @staticmethod
     def clean_files() -> None:
         while True:
             try:
-                path = CleaningExecutor.Q.get_nowait()
-                CleaningExecutor.encode_json_file(path)
+                paths = CleaningExecutor.Q.get_nowait()
+                CleaningExecutor.encode_conversation_files(paths)
             except queue.Empty:
                 break
 
 
-def clean():
-    CleaningExecutor.get_messages_files()
+def clean_with_threads(conversations: List[List[str]]):
+    # whole conversations are queued, so their parts of several exports are joined
+    for paths in conversations:
+        CleaningExecutor.Q.put(paths)
 
     threads = []
     for i in range(Config.get("n_threads")):
@@ -297,24 +1166,117 @@ def clean():
     for thread in threads:
         thread.join()
 
+    # files left in Q would be mistaken for cleaned conversations when joining
+    assert CleaningExecutor.Q.empty(), "Cleaning threads failed, see errors above."
+
+
+def clean_with_processes(conversations: List[List[str]]):
+    """
+    Each worker process cleans whole conversations (with its own spaCy models),
+    users and titles registries are filled in by the main process as results arrive.
+    """
+    with multiprocessing.Pool(
+        processes=Config.get("n_threads"),
+        initializer=CleaningExecutor.init_worker,
+        initargs=(dict(Config.config.__dict__),),
+    ) as pool:
+        for cleaned, stats in pool.imap_unordered(
+            CleaningExecutor.clean_conversation, conversations
+        ):
+            for key, value in stats.items():
+                CleaningExecutor.STATS[key] += value
+            for part in cleaned:
+                CleaningExecutor.register_conversation(*part)
+
+
+def clean():
+    engine = Config.get("engine")
+    assert engine in ("processes", "threads"), f"Unknown cleaning engine: {engine}"
+
+    # only conversations that changed since last run are cleaned
+    manifest = CleaningExecutor.load_manifest()
+    changed, manifest = CleaningExecutor.get_changed_conversations(
+        CleaningExecutor.get_conversations_files(), manifest
+    )
+
+    if engine == "processes":
+        clean_with_processes(changed)
+    else:
+        clean_with_threads(changed)
+
+    stats = CleaningExecutor.STATS
+    logging.info(
+        f"Detected language with {stats['calls']} langdetect calls for {stats['messages']} "
+        f"messages ({stats['messages'] - stats['calls']} calls saved)"
+    )
+
+    cache = CleaningExecutor.get_cache()
+    if cache is not None:
+        logging.info(
+            f"Tokens cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, "
+            f"{cache.evict()} entries evicted"
+        )
+        cache.close()
+        CleaningExecutor.CACHE, CleaningExecutor.CACHE_PID = None, None
+
     CleaningExecutor.save_json(
-        CleaningExecutor.USERS.dt, Config.get("prefix") + "_" + "users.json"
+        CleaningExecutor.USERS.dt,
+        Config.get("prefix") + "_" + "users.json",
+        extend=False,
     )
     CleaningExecutor.save_json(
-        CleaningExecutor.TITLES.dt, Config.get("prefix") + "_" + "titles.json"
+        CleaningExecutor.TITLES.dt,
+        Config.get("prefix") + "_" + "titles.json",
+        extend=False,
     )
 
     users = CleaningExecutor.reverse(CleaningExecutor.USERS.dt, has_list=True)
     conversations = CleaningExecutor.reverse(CleaningExecutor.TITLES.dt)
 
     CleaningExecutor.save_json(
-        users, Config.get("prefix") + "_" + "users_reversed.json"
+        users, Config.get("prefix") + "_" + "users_reversed.json", extend=False
     )
     CleaningExecutor.save_json(
-        conversations, Config.get("prefix") + "_" + "titles_reversed.json"
+        conversations,
+        Config.get("prefix") + "_" + "titles_reversed.json",
+        extend=False,
     )
 
-    messages = CleaningExecutor.join_message_files()
+    corpus_format = Config.get("corpus_format")
+    assert corpus_format in (
+        "json",
+        "columnar",
+        "both",
+    ), f"Unknown corpus format: {corpus_format}"
+    # corpus and emoji index must list conversations in the same order
+    paths = CleaningExecutor.get_conversation_files()
+    if corpus_format != "columnar":
+        CleaningExecutor.join_message_files(
+            Config.get("prefix") + "_" + "conversations.json", paths
+        )
+    if corpus_format != "json":
+        Corpus.write(
+            CleaningExecutor.get_output_path(Config.get("prefix") + "_" + "corpus"),
+            CleaningExecutor.iter_processed_messages(paths),
+        )
+    EmojiIndex.write(
+        CleaningExecutor.get_output_path(Config.get("prefix") + "_" + "emoji_index"),
+        CleaningExecutor.iter_emojis(paths),
+    )
+    np.save(
+        CleaningExecutor.get_output_path(Config.get("prefix") + "_" + "accounts.npy"),
+        np.fromiter(CleaningExecutor.iter_accounts(paths), dtype=np.int64),
+    )
     CleaningExecutor.save_json(
-        messages, Config.get("prefix") + "_" + "conversations.json"
+        CleaningExecutor.get_input_dir_paths(),
+        Config.get("prefix") + "_" + "accounts.json",
+        extend=False,
     )
+    # written after corpus, so queries know it is up to date
+    CleaningExecutor.save_json(
+        CleaningExecutor.get_groups(paths),
+        Config.get("prefix") + "_" + "groups.json",
+        extend=False,
+    )
+
+    CleaningExecutor.save_manifest(manifest, changed)
@@ -0,0 +1,451 @@
+import os
+import json
+import numpy as np
+
+from array import array
+from typing import Any, Iterable, Iterator, List, Tuple
+
+
+class Corpus:
+    """
+    Columnar, dictionary encoded cleaned messages. Each column is a separate .npy file,
+    so it can be memory mapped. Conversations, users and tokens are stored as integer
+    codes into conversations.json, users.json and vocabulary.json lists, tokens of
+    message i are tokens[token_offsets[i] : token_offsets[i + 1]].
+
+    Corpus is also a sequence of (conversation_id, user_id, words, timestamp) rows,
+    same as entries of prefix_conversations.json.
+    """
+
+    COLUMNS = {
+        "conversation": np.int32,
+        "user": np.int32,
+        "timestamp": np.int64,
+        "is_meta": np.bool_,
+        "token_offsets": np.int64,
+        "tokens": np.int32,
+    }
+    # array module typecodes used while writing each column
+    TYPECODES = {
+        "conversation": "i",
+        "user": "i",
+        "timestamp": "q",
+        "is_meta": "b",
+        "token_offsets": "q",
+        "tokens": "i",
+    }
+    DICTIONARIES = ("conversations", "users", "vocabulary")
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, path: str, mmap: bool = True) -> None:
+        self.path = path
+
+        for name, dtype in Corpus.COLUMNS.items():
+            column = np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None
+            )
+            assert (
+                column.dtype == dtype and column.ndim == 1
+            ), f"Corpus {path}: wrong format of {name} column."
+            setattr(self, name, column)
+
+        for name in Corpus.DICTIONARIES:
+            with open(
+                os.path.join(path, f"{name}.json"), "r", encoding="utf-8"
+            ) as file:
+                setattr(self, name, json.load(file))
+
+        assert (
+            len(self.conversation)
+            == len(self.user)
+            == len(self.timestamp)
+            == len(self.is_meta)
+            == len(self.token_offsets) - 1
+        ), f"Corpus {path}: columns have different lengths."
+
+    def __len__(self) -> int:
+        return len(self.conversation)
+
+    def __iter__(self) -> Iterator[tuple]:
+        for start in range(0, len(self), Corpus.CHUNK_SIZE):
+            yield from self.get_rows(start, start + Corpus.CHUNK_SIZE)
+
+    def __getitem__(self, i: int | slice) -> tuple | List[tuple]:
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, "Corpus supports only contiguous slices."
+            return self.get_rows(start, max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Corpus index out of range")
+        return self.get_rows(i, i + 1)[0]
+
+    def get_rows(self, start: int, stop: int) -> List[tuple]:
+        """Decodes rows [start, stop) into python tuples."""
+        stop = min(stop, len(self))
+        conversations = self.conversation[start:stop].tolist()
+        users = self.user[start:stop].tolist()
+        timestamps = self.timestamp[start:stop].tolist()
+        is_meta = self.is_meta[start:stop].tolist()
+        offsets = self.token_offsets[start : stop + 1].tolist()
+        tokens = [
+            self.vocabulary[token]
+            for token in self.tokens[offsets[0] : offsets[-1]].tolist()
+        ]
+
+        rows = [None] * (stop - start)
+        for i in range(stop - start):
+            rows[i] = (
+                self.conversations[conversations[i]],
+                self.users[users[i]],
+                (
+                    "MetaCommand"
+                    if is_meta[i]
+                    else tokens[offsets[i] - offsets[0] : offsets[i + 1] - offsets[0]]
+                ),
+                timestamps[i],
+            )
+        return rows
+
+    def get_groups(self) -> dict:
+        """Same as Query.get_groups, computed on codes columns."""
+        return Corpus.get_codes_groups(
+            self.conversation, self.user, self.conversations, self.users
+        )
+
+    @staticmethod
+    def get_codes_groups(
+        conversation: np.ndarray,
+        user: np.ndarray,
+        conversations: List[str],
+        users: List[str],
+    ) -> dict:
+        """Users of each conversation from conversation and user codes of rows."""
+        users_num = max(len(users), 1)
+        pairs = np.unique(conversation.astype(np.int64) * users_num + user)
+        groups = {}
+        for c, u in zip((pairs // users_num).tolist(), (pairs % users_num).tolist()):
+            groups.setdefault(conversations[c], set()).add(users[u])
+        return groups
+
+    @staticmethod
+    def write(path: str, rows: Iterable[tuple]) -> None:
+        """Writes (conversation_id, user_id, words, timestamp) rows as columnar corpus."""
+        columns = {name: array(code) for name, code in Corpus.TYPECODES.items()}
+        columns["token_offsets"].append(0)
+        dictionaries = {name: {} for name in Corpus.DICTIONARIES}
+
+        def get_code(dictionary: dict, value: Any) -> int:
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(dictionary)
+            return code
+
+        for conversation_id, user_id, message, timestamp in rows:
+            columns["conversation"].append(
+                get_code(dictionaries["conversations"], conversation_id)
+            )
+            columns["user"].append(get_code(dictionaries["users"], user_id))
+            columns["timestamp"].append(timestamp)
+
+            is_meta = not isinstance(message, list)
+            columns["is_meta"].append(is_meta)
+            if not is_meta:
+                columns["tokens"].extend(
+                    get_code(dictionaries["vocabulary"], token) for token in message
+                )
+            columns["token_offsets"].append(len(columns["tokens"]))
+
+        os.makedirs(path, exist_ok=True)
+        for name, dtype in Corpus.COLUMNS.items():
+            column = np.frombuffer(columns[name], dtype=columns[name].typecode)
+            np.save(os.path.join(path, f"{name}.npy"), column.astype(dtype))
+
+        for name, dictionary in dictionaries.items():
+            with open(
+                os.path.join(path, f"{name}.json"), "w", encoding="utf-8"
+            ) as file:
+                json.dump(list(dictionary.keys()), file, ensure_ascii=False)
+
+
+class EmojiIndex:
+    """
+    Emojis found in cleaned messages while cleaning, in corpus order. Entry i is emoji
+    emojis[emoji[i]] made of tokens [position[i], position[i] + span[i]) of message
+    message[i] - index of entry in prefix_conversations.json (row of Corpus).
+    """
+
+    COLUMNS = {
+        "message": np.int64,
+        "position": np.int32,
+        "span": np.int32,
+        "emoji": np.int32,
+    }
+    TYPECODES = {"message": "q", "position": "i", "span": "i", "emoji": "i"}
+
+    def __init__(self, path: str, mmap: bool = True) -> None:
+        self.path = path
+
+        for name, dtype in EmojiIndex.COLUMNS.items():
+            column = np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None
+            )
+            assert (
+                column.dtype == dtype and column.ndim == 1
+            ), f"Emoji index {path}: wrong format of {name} column."
+            setattr(self, name, column)
+
+        with open(os.path.join(path, "emojis.json"), "r", encoding="utf-8") as file:
+            self.emojis = json.load(file)
+
+        assert (
+            len(self.message) == len(self.position) == len(self.span) == len(self.emoji)
+        ), f"Emoji index {path}: columns have different lengths."
+
+    def __len__(self) -> int:
+        return len(self.message)
+
+    def get_neighbours(self, entries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Codes of emojis right before and right after each of entries (their spans
+        touch in the same message), -1 if there is a word or nothing there. Emojis
+        made of several tokens are neighbours as a whole, not as their parts.
+        """
+        message, position = np.asarray(self.message), np.asarray(self.position)
+        end = position + np.asarray(self.span)
+
+        neighbours = []
+        for step in (-1, 1):
+            other = np.clip(entries + step, 0, max(len(self) - 1, 0))
+            first, second = (other, entries) if step == -1 else (entries, other)
+            touching = (
+                (other != entries)
+                & (message[other] == message[entries])
+                & (end[first] == position[second])
+            )
+            neighbours.append(
+                np.where(touching, np.asarray(self.emoji)[other], -1).astype(np.int64)
+            )
+        return neighbours[0], neighbours[1]
+
+    @staticmethod
+    def write(path: str, rows: Iterable[tuple]) -> None:
+        """Writes (message, position, span, emoji) rows as emoji index."""
+        columns = {name: array(code) for name, code in EmojiIndex.TYPECODES.items()}
+        emojis = {}
+
+        for message, position, span, emoji in rows:
+            columns["message"].append(message)
+            columns["position"].append(position)
+            columns["span"].append(span)
+            code = emojis.get(emoji)
+            if code is None:
+                code = emojis[emoji] = len(emojis)
+            columns["emoji"].append(code)
+
+        os.makedirs(path, exist_ok=True)
+        for name, dtype in EmojiIndex.COLUMNS.items():
+            column = np.frombuffer(columns[name], dtype=columns[name].typecode)
+            np.save(os.path.join(path, f"{name}.npy"), column.astype(dtype))
+
+        with open(os.path.join(path, "emojis.json"), "w", encoding="utf-8") as file:
+            json.dump(list(emojis.keys()), file, ensure_ascii=False)
+
+
+class RowIndex:
+    """
+    Rows of corpus (indexes of prefix_conversations.json entries) sorted by timestamp,
+    so rows of a time range are found by binary search - all rows (by_time), and rows
+    of each user and conversation: rows of user code u are
+    by_user[user_offsets[u] : user_offsets[u + 1]]. Each *_timestamp column holds
+    timestamps of rows of the corresponding by_* column. Codes index users.json and
+    conversations.json lists (the same as in Corpus).
+    """
+
+    COLUMNS = (
+        "by_time",
+        "time_timestamp",
+        "by_user",
+        "user_timestamp",
+        "user_offsets",
+        "by_conversation",
+        "conversation_timestamp",
+        "conversation_offsets",
+    )
+    DICTIONARIES = ("conversations", "users")
+
+    def __init__(self, path: str, mmap: bool = True) -> None:
+        columns = {
+            name: np.load(
+                os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None
+            )
+            for name in RowIndex.COLUMNS
+        }
+        dictionaries = {}
+        for name in RowIndex.DICTIONARIES:
+            with open(
+                os.path.join(path, f"{name}.json"), "r", encoding="utf-8"
+            ) as file:
+                dictionaries[name] = json.load(file)
+        self.set(path, columns, dictionaries)
+
+    def set(self, path: str, columns: dict, dictionaries: dict) -> None:
+        self.path = path
+        for name in RowIndex.COLUMNS:
+            column = columns[name]
+            assert (
+                column.dtype == np.int64 and column.ndim == 1
+            ), f"Row index {path}: wrong format of {name} column."
+            setattr(self, name, column)
+        for name in RowIndex.DICTIONARIES:
+            setattr(self, name, dictionaries[name])
+
+        assert (
+            len(self.by_time)
+            == len(self.by_user)
+            == len(self.by_conversation)
+            == self.user_offsets[-1]
+            == self.conversation_offsets[-1]
+        ), f"Row index {path}: columns have different lengths."
+        self.user_codes = {user_id: code for code, user_id in enumerate(self.users)}
+        self.conversation_codes = {
+            conversation_id: code
+            for code, conversation_id in enumerate(self.conversations)
+        }
+
+    def __len__(self) -> int:
+        return len(self.by_time)
+
+    def get_rows(
+        self,
+        since: int = None,
+        until: int = None,
+        user_ids: List[str] = None,
+        conversation_ids: List[str] = None,
+    ) -> np.ndarray:
+        """
+        Sorted rows sent in [since, until) (milliseconds, None for no limit) by one
+        of user_ids in one of conversation_ids (None for all).
+        """
+        selections = []
+        for ids, codes, rows, timestamps, offsets in (
+            (
+                user_ids,
+                self.user_codes,
+                self.by_user,
+                self.user_timestamp,
+                self.user_offsets,
+            ),
+            (
+                conversation_ids,
+                self.conversation_codes,
+                self.by_conversation,
+                self.conversation_timestamp,
+                self.conversation_offsets,
+            ),
+        ):
+            if ids is None:
+                continue
+            found = [codes[i] for i in ids if i in codes]
+            selections.append(
+                np.sort(
+                    np.concatenate(
+                        [np.zeros(0, dtype=np.int64)]
+                        + [
+                            RowIndex.get_range(
+                                rows,
+                                timestamps,
+                                offsets[code],
+                                offsets[code + 1],
+                                since,
+                                until,
+                            )
+                            for code in found
+                        ]
+                    )
+                )
+            )
+
+        if len(selections) == 0:
+            return np.sort(
+                RowIndex.get_range(
+                    self.by_time, self.time_timestamp, 0, len(self), since, until
+                )
+            )
+
+        rows = selections[0]
+        for other in selections[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
+
+    @staticmethod
+    def get_range(
+        rows: np.ndarray,
+        timestamps: np.ndarray,
+        start: int,
+        stop: int,
+        since: int = None,
+        until: int = None,
+    ) -> np.ndarray:
+        """rows[start:stop] with timestamps in [since, until) - by binary search."""
+        timestamps = timestamps[start:stop]
+        first = 0 if since is None else np.searchsorted(timestamps, since, "left")
+        last = len(timestamps) if until is None else np.searchsorted(timestamps, until)
+        return np.asarray(rows[start + first : start + max(first, last)])
+
+    @staticmethod
+    def build(
+        conversation: np.ndarray,
+        user: np.ndarray,
+        timestamp: np.ndarray,
+        conversations: List[str],
+        users: List[str],
+    ) -> "RowIndex":
+        """Index of rows with given codes columns and dictionaries, kept in memory."""
+        index = RowIndex.__new__(RowIndex)
+        index.set(
+            None,
+            RowIndex.get_columns(
+                conversation, user, timestamp, len(conversations), len(users)
+            ),
+            {"conversations": list(conversations), "users": list(users)},
+        )
+        return index
+
+    def write(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in RowIndex.COLUMNS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+        for name in RowIndex.DICTIONARIES:
+            with open(
+                os.path.join(path, f"{name}.json"), "w", encoding="utf-8"
+            ) as file:
+                json.dump(getattr(self, name), file, ensure_ascii=False)
+        self.path = path
+
+    @staticmethod
+    def get_columns(
+        conversation: np.ndarray,
+        user: np.ndarray,
+        timestamp: np.ndarray,
+        conversations_num: int,
+        users_num: int,
+    ) -> dict:
+        columns = {}
+        for name, codes, size in (
+            ("time", None, 0),
+            ("user", user, users_num),
+            ("conversation", conversation, conversations_num),
+        ):
+            if codes is None:
+                rows = np.argsort(timestamp, kind="stable")
+            else:
+                rows = np.lexsort((timestamp, codes))
+                offsets = np.zeros(size + 1, dtype=np.int64)
+                np.cumsum(np.bincount(codes, minlength=size), out=offsets[1:])
+                columns[f"{name}_offsets"] = offsets
+            columns[f"by_{name}"] = rows.astype(np.int64)
+            columns[f"{name}_timestamp"] = np.asarray(timestamp, dtype=np.int64)[rows]
+        return columns
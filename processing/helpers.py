@@ -1,15 +1,23 @@
 import os
 import re
 import json
+import time
+import sys
+import sqlite3
+import hashlib
 import logging
 import warnings
+import numpy as np
 import pandas as pd
+import gender_guesser.detector as gender
 
-from typing import Any, List, Tuple
-from itertools import count
-from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+from itertools import chain, count
+from datetime import datetime, tzinfo
+from zoneinfo import ZoneInfo
 
 from setup import Config
+from corpus import Corpus, RowIndex
 
 
 def encode(*args: List[Any]) -> List[Any]:
@@ -24,6 +32,19 @@ def encode(*args: List[Any]) -> List[Any]:
     return args
 
 
+def fix_encoding(obj: dict) -> dict:
+    """
+    json object_hook repairing mojibake of Meta exports (utf-8 bytes escaped as
+    latin-1 characters) in all string values, so data is decoded once on read.
+    """
+    for key, value in obj.items():
+        if isinstance(value, str):
+            obj[key] = encode(value)[0]
+        elif isinstance(value, list):
+            obj[key] = [encode(v)[0] if isinstance(v, str) else v for v in value]
+    return obj
+
+
 # returns (name, gender)
 def encode_user(
     user_id: str,
@@ -53,6 +74,34 @@ encode_group = (
 
 
 class Query:
+    # config options results of query depend on (part of ResultsCache key)
+    CACHE_OPTIONS = (
+        "user_id",
+        "timezone",
+        "since",
+        "until",
+        "user_ids",
+        "conversation_ids",
+    )
+    # strftime directives by the finest time unit they depend on
+    FORMAT_UNITS = (
+        ("ms", ("%f",)),
+        ("s", ("%S", "%T", "%X", "%c", "%s")),
+        ("m", ("%M", "%R")),
+        ("h", ("%H", "%I", "%p", "%k", "%l")),
+    )
+    # zero padded numeric directives and their width
+    NUMERIC_DIRECTIVES = {"%Y": 4, "%m": 2, "%d": 2, "%H": 2, "%M": 2, "%S": 2}
+    BUCKETS = ("15min", "hour", "day", "week", "2week", "weekday")
+    # utc offsets rarely change and only between quarters of an hour
+    QUARTER = 15 * 60 * 1000
+    DAY = 24 * 60 * 60 * 1000
+    # names of results of queries writing dict of them, each to {root}_{name}{ext}
+    RESULTS = ()
+    # whether execute is split by conversations - partial results of shards of
+    # conversations (execute_partial) are combined by merge
+    SHARDED = False
+
     def __init__(
         self,
         id: str,
@@ -66,20 +115,343 @@ class Query:
     def __call__(self, data: List[tuple], **kwargs):
         logging.info(f"Query_{self.id}:Execution started.")
         assert len(data) > 0, "Empty data list."
+        cache = kwargs.get("results_cache")
+        if cache is not None and cache.restore(self):
+            return
+
         result = self.execute(data, **kwargs)
-        Query.save(result, self.path)
-        logging.info(
-            f"Query_{self.id}:Execution finished, results saved to {self.path}."
-        )
+        self.write(result)
+        if cache is not None:
+            cache.store(self)
+
+    def write(self, result: Any) -> None:
+        if len(self.get_results()) == 0:
+            Query.save(result, self.path)
+            logging.info(
+                f"Query_{self.id}:Execution finished, results saved to {self.path}."
+            )
+            return
+
+        for name, df in result.items():
+            path = self.get_result_path(name)
+            Query.save(df, path)
+            logging.info(
+                f"Query_{self.id}:Execution finished, results saved to {path}."
+            )
 
     def execute(self, data: List[tuple], **kwargs) -> Any:
+        if self.SHARDED:
+            return self.merge([self.execute_partial(data, **kwargs)], data, **kwargs)
         return data
 
+    def execute_partial(self, data: List[tuple], **kwargs) -> Any:
+        """
+        Partial result of messages of kwargs "shard" conversations (of all if not
+        given) - pass it to select_rows as conversation_ids.
+        """
+        raise NotImplementedError(f"Query: {self.id} can't be split into shards.")
+
+    def merge(self, partials: List[Any], data: List[tuple], **kwargs) -> Any:
+        """Result of query from partial results of disjoint shards, in their order."""
+        raise NotImplementedError(f"Query: {self.id} can't be split into shards.")
+
+    def get_paths(self) -> List[str]:
+        """Files written by write(), relative to output directory."""
+        if len(self.get_results()) == 0:
+            return [self.path]
+        return [self.get_result_path(name) for name in self.get_results()]
+
+    def get_results(self) -> Tuple[Any, ...]:
+        """Names of results, RESULTS by default."""
+        return self.RESULTS
+
+    def get_result_path(self, name: Any) -> str:
+        root, extension = os.path.splitext(self.path)
+        return f"{root}_{name}{extension}"
+
+    def get_cache_key(self, fingerprint: str) -> str:
+        """
+        Key of query results in ResultsCache - depends on query input files
+        (fingerprint), class, parameters, CACHE_OPTIONS and code of the query.
+        """
+        options = {name: Config.get(name) for name in self.CACHE_OPTIONS}
+        if options.get("timezone") == "local":
+            options["timezone"] = [os.environ.get("TZ"), *time.tzname, time.timezone]
+
+        return hashlib.blake2b(
+            json.dumps(
+                [
+                    fingerprint,
+                    f"{type(self).__module__}.{type(self).__qualname__}",
+                    vars(self),
+                    options,
+                    ResultsCache.get_code_version(type(self)),
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8"),
+            digest_size=16,
+        ).hexdigest()
+
     def get_date(self, timestamp: int):
-        return datetime.fromtimestamp(timestamp / 1000).strftime(
-            self.timestamp_group_format
+        return (
+            datetime.fromtimestamp(timestamp / 1000, Query.get_timezone())
+            .replace(tzinfo=None)
+            .strftime(self.timestamp_group_format)
+        )
+
+    @staticmethod
+    def get_timezone() -> tzinfo | None:
+        """--timezone, None for system timezone."""
+        timezone = Config.get("timezone")
+        if timezone == "local":
+            return None
+        return ZoneInfo(timezone)
+
+    @staticmethod
+    def get_utc_offsets(timestamps: np.ndarray) -> np.ndarray:
+        """Utc offsets (milliseconds) of --timezone at each timestamp."""
+        timezone = Query.get_timezone()
+        if timezone is None:
+            return (
+                np.array(
+                    [
+                        time.localtime(s).tm_gmtoff
+                        for s in (timestamps // 1000).tolist()
+                    ],
+                    dtype=np.int64,
+                )
+                * 1000
+            )
+
+        utc = pd.to_datetime(timestamps, unit="ms", utc=True)
+        return (
+            (utc.tz_convert(timezone).tz_localize(None) - utc.tz_localize(None))
+            .to_numpy()
+            .astype("timedelta64[ms]")
+            .astype(np.int64)
+        )
+
+    @staticmethod
+    def to_local(timestamps: np.ndarray) -> np.ndarray:
+        """
+        Converts int64 utc milliseconds to wall clock milliseconds in --timezone.
+        Offset is looked up once per distinct quarter of an hour, timestamps are
+        looked up one by one only in quarters when offset changes.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        quarters, inverse = np.unique(timestamps // Query.QUARTER, return_inverse=True)
+        starts = quarters * Query.QUARTER
+        offsets = Query.get_utc_offsets(
+            np.concatenate([starts, starts + Query.QUARTER - 1])
+        ).reshape(2, -1)
+
+        res = offsets[0][inverse]
+        changed = (offsets[0] != offsets[1])[inverse]
+        if changed.any():
+            res[changed] = Query.get_utc_offsets(timestamps[changed])
+        return timestamps + res
+
+    @staticmethod
+    def get_buckets(
+        timestamps: np.ndarray, bucket: str, is_local: bool = False
+    ) -> np.ndarray:
+        """
+        Time bucket of each timestamp in --timezone - start of its 15min, hour, day,
+        week (weeks start on monday) or 2week (pairs of weeks since 1970) as wall
+        clock datetime64[ms], or its weekday (0 is monday). With is_local timestamps
+        are wall clock already (e.g. starts of finer buckets).
+        """
+        assert bucket in Query.BUCKETS, f"Unknown time bucket: {bucket}"
+        local = np.asarray(timestamps)
+        local = local.astype(np.int64) if is_local else Query.to_local(local)
+
+        if bucket in ("15min", "hour"):
+            size = Query.QUARTER if bucket == "15min" else 4 * Query.QUARTER
+            return (local // size * size).astype("datetime64[ms]")
+
+        days = local // Query.DAY
+        # 1970-01-01 was thursday, weeks are counted from monday before it
+        weeks = (days + 3) // 7
+        if bucket == "weekday":
+            return days + 3 - weeks * 7
+        starts = {"day": days, "week": weeks * 7 - 3, "2week": weeks // 2 * 14 - 3}
+        return (starts[bucket] * Query.DAY).astype("datetime64[ms]")
+
+    @staticmethod
+    def get_dates(timestamps: np.ndarray, timestamp_group_format: str) -> np.ndarray:
+        """Vectorized get_date - each distinct date is formatted once."""
+        return Query.format_dates(
+            Query.to_local(timestamps).astype("datetime64[ms]"), timestamp_group_format
         )
 
+    @staticmethod
+    def format_dates(local: np.ndarray, timestamp_group_format: str) -> np.ndarray:
+        """strftime of wall clock datetime64 dates."""
+        unit = "D"
+        for format_unit, directives in Query.FORMAT_UNITS:
+            if any(d in timestamp_group_format for d in directives):
+                unit = format_unit
+                break
+
+        dates = local.astype(f"datetime64[{unit}]")
+        if Query.is_numeric_format(timestamp_group_format, dates):
+            return Query.format_numeric(dates, timestamp_group_format)
+
+        dates, inverse = np.unique(dates, return_inverse=True)
+        return (
+            pd.DatetimeIndex(dates)
+            .strftime(timestamp_group_format)
+            .to_numpy(dtype=object)[inverse]
+        )
+
+    @staticmethod
+    def is_numeric_format(timestamp_group_format: str, dates: np.ndarray) -> bool:
+        """Whether format uses only NUMERIC_DIRECTIVES and all years have 4 digits."""
+        directives = re.findall(r"%.", timestamp_group_format)
+        return all(d in Query.NUMERIC_DIRECTIVES for d in directives) and (
+            len(dates) == 0
+            or (
+                np.datetime64("1000-01-01") <= dates.min()
+                and dates.max() < np.datetime64("10000-01-01")
+            )
+        )
+
+    @staticmethod
+    def format_numeric(dates: np.ndarray, timestamp_group_format: str) -> np.ndarray:
+        """
+        strftime of numeric formats - strings are glued from code points of dates
+        in days range (with literals) and of all seconds of day.
+        """
+        tokens = [t for t in re.split(r"(%.)", timestamp_group_format) if t != ""]
+        width = sum(Query.NUMERIC_DIRECTIVES.get(t, len(t)) for t in tokens)
+        if len(dates) == 0 or width == 0:
+            return np.full(len(dates), "", dtype=object)
+
+        seconds = dates.astype("datetime64[s]").astype(np.int64)
+        day = seconds // (24 * 60 * 60)
+        first = day.min()
+
+        days = np.arange(first, day.max() + 1).astype("datetime64[D]")
+        months = days.astype("datetime64[M]")
+        years = days.astype("datetime64[Y]")
+        days_chars = Query.get_chars(
+            tokens,
+            width,
+            {
+                "%Y": years.astype(np.int64) + 1970,
+                "%m": (months - years).astype(np.int64) + 1,
+                "%d": (days - months).astype(np.int64) + 1,
+            },
+            len(days),
+            with_literals=True,
+        )
+        second_of_day = np.arange(24 * 60 * 60)
+        seconds_chars = Query.get_chars(
+            tokens,
+            width,
+            {
+                "%H": second_of_day // 3600,
+                "%M": second_of_day // 60 % 60,
+                "%S": second_of_day % 60,
+            },
+            len(second_of_day),
+        )
+
+        chars = days_chars[day - first]
+        chars += seconds_chars[seconds - day * (24 * 60 * 60)]
+        return chars.view(f"U{width}").ravel()
+
+    @staticmethod
+    def get_chars(
+        tokens: List[str],
+        width: int,
+        values: Dict[str, np.ndarray],
+        n: int,
+        with_literals: bool = False,
+    ) -> np.ndarray:
+        """Code points of formatted values, zeros in place of other directives."""
+        chars = np.zeros((n, width), dtype=np.uint32)
+        i = 0
+        for token in tokens:
+            if token in Query.NUMERIC_DIRECTIVES:
+                w = Query.NUMERIC_DIRECTIVES[token]
+                if token in values:
+                    for k in range(w):
+                        chars[:, i + k] = values[token] // 10 ** (w - 1 - k) % 10
+                        chars[:, i + k] += ord("0")
+                i += w
+            else:
+                if with_literals:
+                    chars[:, i : i + len(token)] = [ord(c) for c in token]
+                i += len(token)
+        return chars
+
+    @staticmethod
+    def get_timestamp(date: str) -> int:
+        """Timestamp (milliseconds) of date in ISO format, e.g. 2020-10-31 12:00, in --timezone."""
+        date = datetime.fromisoformat(date)
+        if date.tzinfo is None and Query.get_timezone() is not None:
+            date = date.replace(tzinfo=Query.get_timezone())
+        return round(date.timestamp() * 1000)
+
+    @staticmethod
+    def get_predicates() -> Dict[str, Any]:
+        """
+        --since and --until as timestamps, --user_ids and --conversation_ids as lists,
+        None for predicates that were not given.
+        """
+        predicates = {}
+        for name in ("since", "until"):
+            date = Config.get(name, "")
+            predicates[name] = Query.get_timestamp(date) if date else None
+        for name in ("user_ids", "conversation_ids"):
+            ids = Config.get(name, "")
+            predicates[name] = [i for i in ids.split(",") if i != ""] if ids else None
+        return predicates
+
+    @staticmethod
+    def select_rows(
+        data: List[tuple],
+        index: RowIndex = None,
+        users: bool = True,
+        user_ids: List[str] = None,
+        conversation_ids: List[str] = None,
+    ) -> np.ndarray | None:
+        """
+        Sorted rows of data matching --since, --until, --conversation_ids and (with
+        users) --user_ids predicates, narrowed to user_ids and conversation_ids (e.g.
+        shard of query) if given. Rows are found in index (built in memory if not
+        given) by binary search, so only them are read. Returns None if no rows are
+        filtered out.
+        """
+        predicates = Query.get_predicates()
+        if not users:
+            predicates["user_ids"] = None
+        for name, ids in (
+            ("user_ids", user_ids),
+            ("conversation_ids", conversation_ids),
+        ):
+            if ids is not None:
+                if predicates[name] is not None:
+                    allowed = set(predicates[name])
+                    ids = [i for i in ids if i in allowed]
+                predicates[name] = ids
+        if all(value is None for value in predicates.values()):
+            return None
+
+        if index is None:
+            columns = Query.get_columns(data)
+            index = RowIndex.build(
+                columns["conversation"],
+                columns["user"],
+                columns["timestamp"],
+                columns["conversations"],
+                columns["users"],
+            )
+        assert len(index) == len(data), "Row index doesn't match data."
+        return index.get_rows(**predicates)
+
     def get_from_kw(self, kw: dict, name: str, assert_val: Any = None) -> Any:
         val = kw.pop(name, None)
         assert val is not assert_val, f"Query: {self.id} requires {name} to work."
@@ -96,7 +468,7 @@ class Query:
 
         _, extension = os.path.splitext(path)
 
-        if extension == ".csv":
+        if extension == ".csv" or path.endswith(".csv.gz"):
             if not isinstance(result, pd.DataFrame):
                 result = pd.DataFrame(result)
             result.to_csv(path, index=None)
@@ -104,6 +476,147 @@ class Query:
             with open(path, "w") as file:
                 return json.dump(result, file, ensure_ascii=False)
 
+    @staticmethod
+    def get_columns(
+        data: List[tuple],
+        tokens: bool = False,
+        rows: np.ndarray = None,
+        shared: "DataColumns" = None,
+    ) -> Dict[str, Any]:
+        """
+        Conversation and user columns as integer codes into conversations and users
+        lists, timestamp, is_meta and length (number of words, 0 for MetaCommand)
+        columns of data as NumPy arrays. With tokens also token_offsets and tokens -
+        codes into vocabulary, tokens of message i are
+        tokens[token_offsets[i] : token_offsets[i + 1]] (as in Corpus).
+        With rows (e.g. from select_rows) columns hold only these rows of data.
+        Columns are taken from shared columns of data (kwargs "columns" of queries)
+        if given, so data is read once for all queries.
+        """
+        if shared is not None:
+            return shared.get(tokens, rows)
+
+        if hasattr(data, "timestamp"):  # columnar corpus
+            offsets = np.asarray(data.token_offsets)
+            if rows is None:
+                rows = slice(None)
+                starts, stops = offsets[:-1], offsets[1:]
+            else:
+                starts, stops = offsets[rows], offsets[rows + 1]
+
+            columns = {
+                "conversation": np.asarray(data.conversation[rows]),
+                "conversations": data.conversations,
+                "user": np.asarray(data.user[rows]),
+                "users": data.users,
+                "timestamp": np.asarray(data.timestamp[rows]),
+                "is_meta": np.asarray(data.is_meta[rows]),
+                "length": stops - starts,
+            }
+            if tokens and isinstance(rows, slice):
+                columns["token_offsets"] = offsets
+                columns["tokens"] = np.asarray(data.tokens)
+                columns["vocabulary"] = data.vocabulary
+            elif tokens:
+                columns["token_offsets"], columns["tokens"] = Query.take_tokens(
+                    np.asarray(data.tokens), starts, columns["length"]
+                )
+                columns["vocabulary"] = data.vocabulary
+            return columns
+
+        if rows is not None:
+            data = [data[i] for i in rows.tolist()]
+
+        conversation, conversations = pd.factorize(
+            pd.Series([row[0] for row in data], dtype=object)
+        )
+        user, users = pd.factorize(pd.Series([row[-3] for row in data], dtype=object))
+        columns = {
+            "conversation": conversation,
+            "conversations": conversations.tolist(),
+            "user": user,
+            "users": users.tolist(),
+            "timestamp": np.fromiter(
+                (row[-1] for row in data), dtype=np.int64, count=len(data)
+            ),
+            "is_meta": np.fromiter(
+                (row[-2] == "MetaCommand" for row in data), dtype=bool, count=len(data)
+            ),
+            "length": np.fromiter(
+                (len(row[-2]) if isinstance(row[-2], list) else 0 for row in data),
+                dtype=np.int64,
+                count=len(data),
+            ),
+        }
+
+        if tokens:
+            columns.update(Query.get_tokens(data))
+        return columns
+
+    @staticmethod
+    def get_tokens(data: List[tuple]) -> Dict[str, Any]:
+        """token_offsets, tokens and vocabulary columns of (not columnar) data."""
+        messages = [row[-2] if isinstance(row[-2], list) else [] for row in data]
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(
+            np.fromiter(map(len, messages), dtype=np.int64, count=len(data)),
+            out=offsets[1:],
+        )
+        tokens, vocabulary = pd.factorize(
+            pd.Series(list(chain.from_iterable(messages)), dtype=object)
+        )
+        return {
+            "token_offsets": offsets,
+            "tokens": tokens,
+            "vocabulary": vocabulary.tolist(),
+        }
+
+    @staticmethod
+    def take_tokens(
+        tokens: np.ndarray, starts: np.ndarray, lengths: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Token offsets and tokens of messages starting at starts of tokens column."""
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # positions of selected messages tokens in tokens column
+        return (
+            offsets,
+            tokens[np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])],
+        )
+
+    @staticmethod
+    def pack_keys(
+        *keys: np.ndarray,
+    ) -> Tuple[np.ndarray | None, List[Tuple[int, int]]]:
+        """
+        Packs integer keys of each row into one int64, which is much faster to sort
+        or factorize than several columns - packed keys are ordered as rows of keys.
+        Returns None instead of packed keys if they do not fit into int64, and
+        (lowest value, number of values) of each key for unpack_keys.
+        """
+        ranges = []
+        for key in keys:
+            low = int(key.min()) if len(key) > 0 else 0
+            ranges.append((low, int(key.max()) - low + 1 if len(key) > 0 else 1))
+        if np.prod([size for _, size in ranges], dtype=object) >= 2**63:
+            return None, ranges
+
+        packed = np.zeros(len(keys[0]), dtype=np.int64)
+        for key, (low, size) in zip(keys, ranges):
+            packed = packed * size + (key.astype(np.int64) - low)
+        return packed, ranges
+
+    @staticmethod
+    def unpack_keys(
+        packed: np.ndarray, ranges: List[Tuple[int, int]]
+    ) -> List[np.ndarray]:
+        """Keys packed by pack_keys."""
+        keys = []
+        for low, size in ranges[::-1]:
+            packed, key = np.divmod(packed, size)
+            keys.append(key + low)
+        return keys[::-1]
+
     @staticmethod
     def get_groups(data: List[tuple]) -> dict:
         conversation_users = {}
@@ -130,15 +643,95 @@ class Query:
         return df
 
 
-class GenderPredictorForPolishNames:
-    def __init__(self) -> None:
-        self.names = pd.read_excel(
-            os.path.join(os.path.dirname(__file__), "resources", "imiona_polskie.xlsx")
+class DataColumns:
+    """
+    Query.get_columns of data shared by all queries - data is read once, columns of
+    rows selected by queries are taken from them. Each selection is memoized.
+    """
+
+    COLUMNS = ("conversation", "user", "timestamp", "is_meta", "length")
+
+    def __init__(self, data: List[tuple]) -> None:
+        self.data = data
+        self.columns = {}
+
+    def get(self, tokens: bool = False, rows: np.ndarray = None) -> Dict[str, Any]:
+        key = (
+            tokens,
+            None if rows is None else hashlib.blake2b(rows.tobytes()).digest(),
+        )
+        if key in self.columns:
+            return self.columns[key]
+
+        if rows is not None:
+            columns = DataColumns.take_rows(self.get(tokens), rows)
+        elif tokens and not hasattr(self.data, "timestamp"):
+            # other columns of json data are already read
+            columns = {**self.get(), **Query.get_tokens(self.data)}
+        else:
+            columns = Query.get_columns(self.data, tokens=tokens)
+        self.columns[key] = columns
+        return columns
+
+    def get_groups(self) -> dict:
+        """Same as Query.get_groups, computed on shared columns instead of rows."""
+        columns = self.get()
+        return Corpus.get_codes_groups(
+            columns["conversation"],
+            columns["user"],
+            columns["conversations"],
+            columns["users"],
         )
-        self.names = {
-            name.lower(): gender
-            for name, gender in zip(self.names.imie, self.names.plec)
+
+    @staticmethod
+    def take_rows(columns: Dict[str, Any], rows: np.ndarray) -> Dict[str, Any]:
+        """Columns of rows, codes still refer to all conversations and users."""
+        selected = {
+            **columns,
+            **{name: columns[name][rows] for name in DataColumns.COLUMNS},
         }
+        if "tokens" in columns:
+            selected["token_offsets"], selected["tokens"] = Query.take_tokens(
+                columns["tokens"], columns["token_offsets"][rows], selected["length"]
+            )
+        return selected
+
+
+class GenderPredictorForPolishNames:
+    NAMES_PATH = os.path.join(
+        os.path.dirname(__file__), "resources", "imiona_polskie.xlsx"
+    )
+
+    def __init__(self) -> None:
+        self.names = GenderPredictorForPolishNames.load_names()
+
+    @staticmethod
+    def load_names() -> dict:
+        """
+        Returns {lowercase name: gender} table. It is compiled from .xlsx on first use
+        and cached as .json in output directory (parsing .xlsx with openpyxl is slow).
+        """
+        xlsx_path = GenderPredictorForPolishNames.NAMES_PATH
+        json_path = GenderPredictorForPolishNames.get_cache_path()
+        if os.path.exists(json_path) and os.path.getmtime(
+            json_path
+        ) >= os.path.getmtime(xlsx_path):
+            with open(json_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+
+        names = pd.read_excel(xlsx_path)
+        names = {name.lower(): gender for name, gender in zip(names.imie, names.plec)}
+        try:
+            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+            with open(json_path, "w", encoding="utf-8") as file:
+                json.dump(names, file, ensure_ascii=False)
+        except OSError as e:
+            warnings.warn(f"Could not cache polish names table: {e}")
+        return names
+
+    @staticmethod
+    def get_cache_path() -> str:
+        return os.path.join(Config.get("output_dir_path"), "polish_names.json")
 
     def predict_gender(self, name: str) -> str:
         gender = self.names.get(name.lower(), "unknown")
@@ -147,6 +740,38 @@ class GenderPredictorForPolishNames:
         return gender
 
 
+class GenderResolver:
+    """
+    Resolves gender of first names - with polish names table first, then with
+    gender_guesser. Results are memoized per name, lookups only read shared tables,
+    so it is safe to use from many threads without a lock.
+    """
+
+    def __init__(self) -> None:
+        self.polish = GenderPredictorForPolishNames()
+        self.detector = gender.Detector(case_sensitive=False)
+        self.memo = {}
+
+    def resolve(self, name: str) -> str:
+        gender = self.polish.predict_gender(name)
+        if gender == "unknown":
+            gender = self.detector.get_gender(name)
+            if gender == "mostly_male":
+                return "male"
+            elif gender == "mostly_female":
+                return "female"
+        return gender
+
+    def get_gender(self, name: str) -> str:
+        gender = self.memo.get(name)
+        if gender is None:
+            gender = self.memo[name] = self.resolve(name)
+        return gender
+
+    def get_genders(self, names: List[str]) -> List[str]:
+        return [self.get_gender(name) for name in names]
+
+
 class Counter:
     COUNTER = count(start=1)
 
@@ -155,6 +780,14 @@ class Counter:
         self.dt = {}
         self.lock = lock
 
+    def load(
+        self, dt: dict, get_id: Callable[[Any], str] = lambda value: value
+    ) -> None:
+        """Restores ids saved by previous run, new ids continue their numbering."""
+        self.dt = dt
+        last = max((int(get_id(v).rsplit("_", 1)[-1]) for v in dt.values()), default=0)
+        self.counter = count(start=last + 1)
+
     def set(self, key: str, value: Any) -> None:
         with self.lock:
             self.dt[key] = value
@@ -167,70 +800,335 @@ class Counter:
             return f"{Config.get('prefix')}_{next(self.counter)}"
 
 
+class TokensCache:
+    """
+    SQLite backed cache of cleaned messages tokens, shared between runs (and processes).
+    Entries are content addressed, least recently used ones are evicted above max_entries.
+    """
+
+    # sqlite default limit of variables in one statement is 999
+    CHUNK_SIZE = 900
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, timeout=120, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tokens "
+            "(key BLOB PRIMARY KEY, tokens TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(content: str, language: str, model: str) -> bytes:
+        return hashlib.blake2b(
+            "\0".join((model, language, content)).encode("utf-8"), digest_size=16
+        ).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, List[str]]:
+        found = {}
+        for i in range(0, len(keys), TokensCache.CHUNK_SIZE):
+            chunk = keys[i : i + TokensCache.CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, tokens FROM tokens WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            found.update((key, json.loads(tokens)) for key, tokens in rows)
+
+            # refresh hit entries, so they are not evicted
+            self.connection.execute(
+                f"UPDATE tokens SET used = ? WHERE key IN ({placeholders})",
+                [time.time(), *chunk],
+            )
+        self.connection.commit()
+
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def set_many(self, items: Dict[bytes, List[str]]) -> None:
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tokens (key, tokens, used) VALUES (?, ?, ?)",
+            [
+                (key, json.dumps(tokens, ensure_ascii=False), now)
+                for key, tokens in items.items()
+            ],
+        )
+        self.connection.commit()
+
+    def evict(self) -> int:
+        removed = self.connection.execute(
+            "DELETE FROM tokens WHERE key IN "
+            "(SELECT key FROM tokens ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self.connection.commit()
+        return removed
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ResultsCache:
+    """
+    SQLite backed cache of query results files, so query run again on the same input
+    files, with the same parameters and code is not executed. Least recently used
+    results are evicted above max_size bytes.
+    """
+
+    CODE_VERSIONS = {}
+
+    def __init__(self, path: str, max_size: int, fingerprint: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.fingerprint = fingerprint
+        self.connection = None
+        self.pid = None
+
+        connection = self.get_connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT NOT NULL, name TEXT NOT NULL, "
+            "content BLOB NOT NULL, used REAL NOT NULL, PRIMARY KEY (key, name))"
+        )
+        connection.commit()
+
+    def __getstate__(self) -> dict:
+        # workers open their own connections
+        return {**self.__dict__, "connection": None, "pid": None}
+
+    def get_connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared with forked workers
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.path, timeout=120, check_same_thread=False
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.pid = os.getpid()
+        return self.connection
+
+    @staticmethod
+    def get_fingerprint(paths: List[str]) -> str:
+        """Fingerprint of files (or directories) by their names, sizes and mtimes."""
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, p) for p in sorted(os.listdir(path)))
+            elif os.path.exists(path):
+                files.append(path)
+
+        signatures = []
+        for path in files:
+            stat = os.stat(path)
+            signatures.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        return hashlib.blake2b(
+            json.dumps(signatures).encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    @staticmethod
+    def get_code_version(query_class: type) -> str:
+        """
+        Hash of source files of the query class module, of this module and of
+        modules it depends on - corpus (columns and rows index) and setup (options).
+        """
+        module = sys.modules[query_class.__module__].__file__
+        if module not in ResultsCache.CODE_VERSIONS:
+            code_hash = hashlib.blake2b(digest_size=16)
+            sources = {
+                module,
+                __file__,
+                sys.modules[RowIndex.__module__].__file__,
+                sys.modules[Config.__module__].__file__,
+            }
+            for path in sorted(sources):
+                with open(path, "rb") as file:
+                    code_hash.update(file.read())
+            ResultsCache.CODE_VERSIONS[module] = code_hash.hexdigest()
+        return ResultsCache.CODE_VERSIONS[module]
+
+    def restore(self, query: "Query") -> bool:
+        """Writes cached results files of query, returns False if they are not cached."""
+        key = query.get_cache_key(self.fingerprint)
+        connection = self.get_connection()
+        files = dict(
+            connection.execute(
+                "SELECT name, content FROM results WHERE key = ?", (key,)
+            ).fetchall()
+        )
+        if set(files.keys()) != set(query.get_paths()):
+            return False
+
+        for name, content in files.items():
+            path = os.path.join(Config.get("output_dir_path"), name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as file:
+                file.write(content)
+
+        connection.execute(
+            "UPDATE results SET used = ? WHERE key = ?", (time.time(), key)
+        )
+        connection.commit()
+        logging.info(f"Query_{query.id}:Results restored from cache.")
+        return True
+
+    def store(self, query: "Query") -> None:
+        """Caches results files of query written by its write()."""
+        files = {}
+        for name in query.get_paths():
+            with open(os.path.join(Config.get("output_dir_path"), name), "rb") as file:
+                files[name] = file.read()
+        if sum(len(content) for content in files.values()) > self.max_size:
+            return
+
+        key = query.get_cache_key(self.fingerprint)
+        now = time.time()
+        connection = self.get_connection()
+        connection.execute("DELETE FROM results WHERE key = ?", (key,))
+        connection.executemany(
+            "INSERT INTO results (key, name, content, used) VALUES (?, ?, ?, ?)",
+            [(key, name, content, now) for name, content in files.items()],
+        )
+        connection.commit()
+        self.evict()
+
+    def evict(self) -> int:
+        """Removes least recently used results above max_size, returns their number."""
+        connection = self.get_connection()
+        rows = connection.execute(
+            "SELECT key, SUM(LENGTH(content)) FROM results "
+            "GROUP BY key ORDER BY MAX(used) DESC"
+        ).fetchall()
+
+        size, removed = 0, []
+        for key, key_size in rows:
+            size += key_size
+            if size > self.max_size:
+                removed.append(key)
+        connection.executemany(
+            "DELETE FROM results WHERE key = ?", [(key,) for key in removed]
+        )
+        connection.commit()
+        return len(removed)
+
+    def clear(self) -> None:
+        connection = self.get_connection()
+        connection.execute("DELETE FROM results")
+        connection.commit()
+        connection.execute("VACUUM")
+
+
 class BannedWords:
+    WILDCARD = "*"
     BANNED_PHRASES = [
-        "ustawiono nick u\u00c5\u00bcytownika",
-        "ustawi\u00c5\u0082a nick",
-        "ustawi\u00c5\u0082 nick",
-        "ustawi\u00c5\u0082 Tw\u00c3\u00b3j nick",
-        "ustawi\u00c5\u0082a Tw\u00c3\u00b3j nick",
-        "ustawi\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) szybk\u00c4\u0085 reakcj\u00c4\u0099",
-        "ustawi\u00c5\u0082(a) szybk\u00c4\u0085 reakcj\u00c4\u0099",
-        "ustawi\u00c5\u0082 szybk\u00c4\u0085 reakcj\u00c4\u0099",
-        "ustawi\u00c5\u0082a szybk\u00c4\u0085 reakcj\u00c4\u0099",
-        "zmieni\u00c5\u0082(a) zdj\u00c4\u0099cie grupy",
-        "zmieni\u00c5\u0082 zdj\u00c4\u0099cie grupy",
-        "zmieni\u00c5\u0082a zdj\u00c4\u0099cie grupy",
-        "zmieni\u00c5\u0082e\u00c5\u009b zdj\u00c4\u0099cie grupy",
-        "zmieni\u00c5\u0082a\u00c5\u009b zdj\u00c4\u0099cie grupy",
-        "zmieni\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) zdj\u00c4\u0099cie grupy",
-        "doda\u00c5\u0082 Ci\u00c4\u0099 do grupy",
-        "doda\u00c5\u0082(a) Ci\u00c4\u0099 do grupy",
-        "doda\u00c5\u0082a Ci\u00c4\u0099 do grupy",
-        r"doda\u00c5\u0082 (.+?) do grupy",
-        r"doda\u00c5\u0082a (.+?) do grupy",
-        r"doda\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) (.+?) do grupy",
-        r"doda\u00c5\u0082e\u00c5\u009b (.+?) do grupy",
-        r"doda\u00c5\u0082a\u00c5\u009b (.+?) do grupy",
-        "opusci\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) grup\u00c4\u0099",
-        "opu\u00c5\u009bci\u00c5\u0082(a) grup\u00c4\u0099",
-        "opu\u00c5\u009bci\u00c5\u0082 grup\u00c4\u0099",
-        "opu\u00c5\u009bci\u00c5\u0082a grup\u00c4\u0099",
-        "usun\u00c4\u0085\u00c5\u0082(\u00c4\u0099\u00c5\u0082a) Ci\u00c4\u0099 z grupy",
-        "usun\u00c4\u0085\u00c5\u0082 Ci\u00c4\u0099 z grupy",
-        "usun\u00c4\u0099\u00c5\u0082a Ci\u00c4\u0099",
-        "zosta\u00c5\u0082(a) usuni\u00c4\u0099ty(a)",
-        "usun\u00c4\u0085\u00c5\u0082 u\u00c5\u00bcytkownika",
-        "usun\u00c4\u0099\u00c5\u0082a u\u00c5\u00bcytkonika",
-        r"usun\u00c4\u0085\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) (.+?) z grupy",
-        r"usun\u00c4\u0085\u00c5\u0082e\u00c5\u009b (.+?) z grupy",
-        r"usun\u00c4\u0099\u00c5\u0082a\u00c5\u009b (.+?) z grupy",
-        r"usun\u00c4\u0085\u00c5\u0082 (.+?) z grupy",
-        r"usun\u00c4\u0099\u00c5\u0082a (.+?) z grupy",
-        "zmieni\u00c5\u0082 motyw",
-        "zmieni\u00c5\u0082a motyw",
-        "zmieni\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) motyw",
-        "zmieni\u00c5\u0082e\u00c5\u009b motyw",
-        "zmieni\u00c5\u0082a\u00c5\u009b motyw",
-        "dzwoni\u00c5\u0082 do Ciebie",
-        "Zadzwoni\u00c5\u0082e\u00c5\u009b do",
-        "Zadzwoni\u00c5\u0082a\u00c5\u009b do",
-        "masz nieodebrane po\u00c5\u0082\u00c4\u0085czenie od",
-        "ta ankieta nie jest ju\u00c5\u00bc dost\u00c4\u0099pna",
-        "do\u00c5\u0082\u00c4\u0085czy\u00c5\u0082 do rozmowy",
-        "do\u00c5\u0082\u00c4\u0085czy\u00c5\u0082a do rozmowy",
-        "do\u00c5\u0082\u00c4\u0085czy\u00c5\u0082e\u00c5\u009b do rozmowy",
-        "do\u00c5\u0082\u00c4\u0085czy\u00c5\u0082a\u00c5\u009b do rozmowy",
-        "do\u00c5\u0082\u00c4\u0085czy\u00c5\u0082e\u00c5\u009b(a\u00c5\u009b) do rozmowy",
-        "rozpocz\u00c4\u0085\u00c5\u0082 rozmow\u00c4\u0099",
-        "rozpocz\u00c4\u0099\u00c5\u0082a rozmow\u00c4\u0099",
-        "rozpocz\u00c4\u0085\u00c5\u0082e\u00c5\u009b rozmow\u00c4\u0099",
-        "rozpocz\u00c4\u0085\u00c5\u0082e\u00c5\u009b rozmow\u00c4\u0099",
+        "ustawiono nick użytownika",
+        "ustawiła nick",
+        "ustawił nick",
+        "ustawił Twój nick",
+        "ustawiła Twój nick",
+        "ustawiłeś(aś) szybką reakcję",
+        "ustawił(a) szybką reakcję",
+        "ustawił szybką reakcję",
+        "ustawiła szybką reakcję",
+        "zmienił(a) zdjęcie grupy",
+        "zmienił zdjęcie grupy",
+        "zmieniła zdjęcie grupy",
+        "zmieniłeś zdjęcie grupy",
+        "zmieniłaś zdjęcie grupy",
+        "zmieniłeś(aś) zdjęcie grupy",
+        "dodał Cię do grupy",
+        "dodał(a) Cię do grupy",
+        "dodała Cię do grupy",
+        "dodał * do grupy",
+        "dodała * do grupy",
+        "dodałeś(aś) * do grupy",
+        "dodałeś * do grupy",
+        "dodałaś * do grupy",
+        "opusciłeś(aś) grupę",
+        "opuścił(a) grupę",
+        "opuścił grupę",
+        "opuściła grupę",
+        "usunął(ęła) Cię z grupy",
+        "usunął Cię z grupy",
+        "usunęła Cię",
+        "został(a) usunięty(a)",
+        "usunął użytkownika",
+        "usunęła użytkonika",
+        "usunąłeś(aś) * z grupy",
+        "usunąłeś * z grupy",
+        "usunęłaś * z grupy",
+        "usunął * z grupy",
+        "usunęła * z grupy",
+        "zmienił motyw",
+        "zmieniła motyw",
+        "zmieniłeś(aś) motyw",
+        "zmieniłeś motyw",
+        "zmieniłaś motyw",
+        "dzwonił do Ciebie",
+        "Zadzwoniłeś do",
+        "Zadzwoniłaś do",
+        "masz nieodebrane połączenie od",
+        "ta ankieta nie jest już dostępna",
+        "dołączył do rozmowy",
+        "dołączyła do rozmowy",
+        "dołączyłeś do rozmowy",
+        "dołączyłaś do rozmowy",
+        "dołączyłeś(aś) do rozmowy",
+        "rozpoczął rozmowę",
+        "rozpoczęła rozmowę",
+        "rozpocząłeś rozmowę",
+        "rozpocząłeś rozmowę",
     ]
 
+    @staticmethod
+    def compile(phrases: List[str]) -> re.Pattern:
+        """
+        Builds single regex out of phrases prefix tree, so message is scanned once
+        for all of them. Phrases are matched literally and case insensitive, except
+        WILDCARD which matches any text (ie. name of user).
+        """
+        trie = {}
+        for phrase in phrases:
+            node = trie
+            for char in phrase.lower():
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def to_regex(node: dict) -> str:
+            # phrase ends here - longer phrases sharing this prefix are redundant
+            if "" in node:
+                return ""
+            branches = [
+                (".+?" if char == BannedWords.WILDCARD else re.escape(char))
+                + to_regex(child)
+                for char, child in node.items()
+            ]
+            if len(branches) == 1:
+                return branches[0]
+            return "(?:" + "|".join(branches) + ")"
+
+        if len(trie) == 0:
+            return re.compile("(?!)")
+        return re.compile(to_regex(trie))
+
+    @staticmethod
+    def extend(phrases: List[str]) -> None:
+        """Adds phrases (ie. system messages of other Messenger languages)."""
+        BannedWords.BANNED_PHRASES.extend(phrases)
+        BannedWords.PATTERN = BannedWords.compile(BannedWords.BANNED_PHRASES)
+
     @staticmethod
     def is_banned(message: str) -> bool:
-        for to_delete in BannedWords.BANNED_PHRASES:
-            if re.search(re.escape(to_delete).lower(), message.lower()):
-                return True
-        return False
+        return BannedWords.PATTERN.search(message.lower()) is not None
+
+
+BannedWords.PATTERN = BannedWords.compile(BannedWords.BANNED_PHRASES)
@@ -20,6 +20,7 @@ if __name__ == "__main__":
     t1 = time.time()
     from query_manager import query
 
+    logging.info(f"Imported queries, took {time.time() - t1:.2f} seconds")
     query()
     logging.info(f"Executed all queries, took {time.time() - t1:.2f} seconds")
 
@@ -1,10 +1,11 @@
-import emoji
+import os
+import logging
+import numpy as np
 import pandas as pd
 
-from typing import Any, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from setup import Config
-from helpers import Query, encode_user, encode_group, encode
-from datetime import datetime
+from helpers import Query, ResultsCache, encode_user, encode_group
 
 
 class CountMessagesQuery(Query):
@@ -14,6 +15,8 @@ class CountMessagesQuery(Query):
     each entry defined in min_messages_num
     """
 
+    SHARDED = True
+
     def __init__(
         self,
         min_messages_num: List[int] = [0, 3, 7, 15],
@@ -21,99 +24,676 @@ class CountMessagesQuery(Query):
         super().__init__("count_messages", ".csv")
         self.min_messages_num = min_messages_num
 
-    def execute(self, data: List[tuple], **kwargs) -> Any:
+    def execute_partial(self, data: List[tuple], **kwargs) -> pd.DataFrame:
         users = self.get_from_kw(kwargs, "users_map", None)
         groups = self.get_from_kw(kwargs, "groups", None)
         faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        columns = Query.get_columns(
+            data,
+            rows=Query.select_rows(
+                data, kwargs.get("row_index"), conversation_ids=kwargs.get("shard")
+            ),
+            shared=kwargs.get("columns"),
+        )
 
-        counts = {}
-        for conversation_id, user_id, message, timestamp in data:
-            if message == "MetaCommand":
-                continue
+        rows = np.flatnonzero(~columns["is_meta"])
+        date, dates = pd.factorize(
+            Query.get_dates(columns["timestamp"][rows], self.timestamp_group_format)
+        )
+        group, conversation, user, date = CountMessagesQuery.group(
+            columns["conversation"][rows], columns["user"][rows], date
+        )
+        at_least = self.count(group, len(date), columns["length"][rows])
 
-            date = self.get_date(timestamp)
-            key = (conversation_id, user_id, date)
+        result = pd.DataFrame(
+            {
+                "conversation_id": np.asarray(columns["conversations"], dtype=object)[
+                    conversation
+                ],
+                "user_id": np.asarray(columns["users"], dtype=object)[user],
+                "date": np.asarray(dates, dtype=object)[date],
+            }
+        )
+        # metadata of each (conversation, user) pair, attached with a single merge
+        users_num = max(len(columns["users"]), 1)
+        pairs = np.unique(conversation * users_num + user)
+        result = result.merge(
+            CountMessagesQuery.get_metadata(
+                *np.divmod(pairs, users_num), columns, users, groups, faked_users
+            ),
+            on=["conversation_id", "user_id"],
+            how="left",
+        )
 
-            if key in counts.keys():
-                for i, num in enumerate(self.min_messages_num):
-                    if len(message) >= num:
-                        counts[key][i] += 1
-            else:
-                counts[key] = [
-                    1 if len(message) >= num else 0 for num in self.min_messages_num
-                ]
+        for j, num in enumerate(self.min_messages_num):
+            result[f"min_messages_is_{num}"] = at_least[:, j]
+        return result
+
+    def merge(
+        self, partials: List[pd.DataFrame], data: List[tuple], **kwargs
+    ) -> pd.DataFrame:
+        # shards hold distinct conversations, so their groups are just put together
+        frames = [df for df in partials if len(df) > 0]
+        if len(frames) <= 1:
+            return frames[0] if len(frames) > 0 else partials[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def count(
+        self, group: np.ndarray, groups_num: int, lengths: np.ndarray
+    ) -> np.ndarray:
+        """
+        Number of messages at least min_messages_num long in each group - histogram
+        of lengths binned by thresholds, cumulated from the longest bin.
+        """
+        thresholds = np.sort(np.asarray(self.min_messages_num, dtype=np.int64))
+        bins = np.searchsorted(thresholds, lengths, side="right")
+        histogram = np.bincount(
+            group * (len(thresholds) + 1) + bins,
+            minlength=groups_num * (len(thresholds) + 1),
+        ).reshape(groups_num, len(thresholds) + 1)
+        at_least = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        return at_least[:, np.searchsorted(thresholds, self.min_messages_num)]
+
+    @staticmethod
+    def group(
+        conversation: np.ndarray, user: np.ndarray, bucket: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Numbers (conversation, user, bucket) groups in order of their first row,
+        returns group of each row and conversation, user and bucket of each group.
+        """
+        bucket_code, buckets = pd.factorize(bucket)
+        key, ranges = Query.pack_keys(conversation, user, bucket_code)
+        assert key is not None, "Too many (conversation, user, bucket) groups."
+        group, keys = pd.factorize(key)
+        conversation, user, bucket_code = Query.unpack_keys(keys, ranges)
+        return group, conversation, user, np.asarray(buckets)[bucket_code]
+
+    @staticmethod
+    def get_metadata(
+        pair_conversation: np.ndarray,
+        pair_user: np.ndarray,
+        columns: Dict[str, Any],
+        users: dict,
+        groups: dict,
+        faked_users: dict,
+    ) -> pd.DataFrame:
+        """Name, gender, is_group and participants_num of (conversation, user) pairs."""
+        encoded_users = [
+            encode_user(user_id, users, faked_users=faked_users)
+            for user_id in columns["users"]
+        ]
+        encoded_groups = [
+            encode_group(conversation_id, groups)
+            for conversation_id in columns["conversations"]
+        ]
 
         return pd.DataFrame(
             [
-                encode(
-                    *key,
-                    *encode_user(key[1], users, faked_users=faked_users),
-                    *encode_group(key[0], groups),
-                    *value,
-                )
-                for key, value in counts.items()
+                [
+                    columns["conversations"][c],
+                    columns["users"][u],
+                    *encoded_users[u],
+                    *encoded_groups[c],
+                ]
+                for c, u in zip(pair_conversation.tolist(), pair_user.tolist())
             ],
             columns=[
                 "conversation_id",
                 "user_id",
-                "date",
                 "name",
                 "gender",
                 "is_group",
                 "participants_num",
+            ],
+        )
+
+
+class CountMessagesRollup(CountMessagesQuery):
+    """
+    Cubes of CountMessagesQuery counts at LEVELS time granularities, saved to one
+    compressed csv with columns level, date (start of bucket in --timezone),
+    conversation_id, user_id, name, gender, is_group, participants_num and number
+    of messages that exceed length num for each entry of min_messages_num.
+    Messages are grouped into 15 minutes buckets once, each coarser level is summed
+    from the previous one.
+    """
+
+    # level (Query.get_buckets bucket): date format
+    LEVELS = {
+        "15min": "%Y-%m-%d %H:%M",
+        "hour": "%Y-%m-%d %H:%M",
+        "day": "%Y-%m-%d",
+        "week": "%Y-%m-%d",
+        "2week": "%Y-%m-%d",
+    }
+
+    def __init__(
+        self,
+        min_messages_num: List[int] = [0, 3, 7, 15],
+    ) -> None:
+        Query.__init__(self, "rollup", ".csv.gz")
+        self.min_messages_num = min_messages_num
+
+    def execute_partial(self, data: List[tuple], **kwargs) -> pd.DataFrame:
+        users = self.get_from_kw(kwargs, "users_map", None)
+        groups = self.get_from_kw(kwargs, "groups", None)
+        faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        columns = Query.get_columns(
+            data,
+            rows=Query.select_rows(
+                data, kwargs.get("row_index"), conversation_ids=kwargs.get("shard")
+            ),
+            shared=kwargs.get("columns"),
+        )
+
+        rows = np.flatnonzero(~columns["is_meta"])
+        conversation, user = columns["conversation"][rows], columns["user"][rows]
+        bucket = Query.to_local(columns["timestamp"][rows])
+        lengths = columns["length"][rows]
+
+        users_num = max(len(columns["users"]), 1)
+        pairs = np.unique(conversation.astype(np.int64) * users_num + user)
+        metadata = CountMessagesQuery.get_metadata(
+            *np.divmod(pairs, users_num), columns, users, groups, faked_users
+        )
+        # cubes are kept as codes into categories shared by all levels
+        categories = {
+            "level": list(self.LEVELS),
+            "conversation_id": columns["conversations"],
+            "user_id": columns["users"],
+        }
+        for column in metadata.columns[2:]:
+            categories[column] = pd.Categorical(metadata[column])
+        codes = {column: [] for column in ["date", *categories]}
+        dates, cubes = [], []
+
+        for i, (level, date_format) in enumerate(self.LEVELS.items()):
+            # buckets start inside buckets of coarser levels, so each level is
+            # bucketed from starts of the previous one
+            bucket = Query.get_buckets(bucket, level, is_local=True).astype(np.int64)
+            if i == 0:
+                group, conversation, user, bucket = CountMessagesQuery.group(
+                    conversation, user, bucket
+                )
+                counts = self.count(group, len(bucket), lengths)
+            else:
+                group, conversation, user, bucket = CountMessagesQuery.group(
+                    conversation, user, bucket
+                )
+                counts = np.stack(
+                    [
+                        np.bincount(group, weights=counts[:, j], minlength=len(bucket))
+                        for j in range(counts.shape[1])
+                    ],
+                    axis=1,
+                ).astype(np.int64)
+            cubes.append(counts)
+
+            # dates are formatted once per bucket, metadata taken by pair
+            starts, inverse = np.unique(bucket, return_inverse=True)
+            codes["date"].append(inverse + sum(len(d) for d in dates))
+            dates.append(
+                Query.format_dates(starts.astype("datetime64[ms]"), date_format)
+            )
+            codes["level"].append(np.full(len(bucket), i))
+            codes["conversation_id"].append(conversation)
+            codes["user_id"].append(user)
+            pair = np.searchsorted(pairs, conversation * users_num + user)
+            for column in metadata.columns[2:]:
+                codes[column].append(categories[column].codes[pair])
+
+        # the same date may start buckets of several levels
+        categories["date"], date = np.unique(np.concatenate(dates), return_inverse=True)
+        codes["date"] = [date[np.concatenate(codes["date"])]]
+
+        result = {
+            column: pd.Categorical.from_codes(
+                np.concatenate(codes.pop(column)),
+                getattr(categories[column], "categories", categories[column]),
+            )
+            for column in [
+                "level",
+                "date",
+                "conversation_id",
+                "user_id",
+                *metadata.columns[2:],
+            ]
+        }
+        counts = np.concatenate(cubes)
+        for j, num in enumerate(self.min_messages_num):
+            result[f"min_messages_is_{num}"] = counts[:, j]
+        return pd.DataFrame(result)
+
+    def merge(
+        self, partials: List[pd.DataFrame], data: List[tuple], **kwargs
+    ) -> pd.DataFrame:
+        result = super().merge(partials, data, **kwargs)
+        if len(partials) == 1:
+            return result
+        # levels of shards are put together, so rows are ordered by level again
+        order = np.argsort(result["level"].cat.codes.to_numpy(), kind="stable")
+        return result.iloc[order].reset_index(drop=True)
+
+
+class RunningTotalsQuery(Query):
+    """
+    Running totals of messages on a grid of dates (--grid_since, then every
+    --grid_days days up to --grid_until, in --timezone) - number of messages sent
+    before each date by each user (saved to prefix_query_running_totals_users.csv
+    with columns date, user_id, name, gender, messages) and in each conversation
+    (prefix_query_running_totals_conversations.csv with columns date,
+    conversation_id, is_group, participants_num, names - of participants other
+    than --user_id, messages). Users and conversations appear from the first date
+    with any messages before it. Messages are binned to grid dates by binary search
+    and totals are prefix sums of bins, so dates cost only output rows.
+    """
+
+    CACHE_OPTIONS = Query.CACHE_OPTIONS + ("grid_since", "grid_until", "grid_days")
+    RESULTS = ("users", "conversations")
+    SHARDED = True
+
+    def __init__(self) -> None:
+        super().__init__("running_totals", ".csv")
+
+    def execute_partial(self, data: List[tuple], **kwargs) -> Dict[str, Any]:
+        """
+        Numbers of messages of each user and conversation on each (wall clock) day
+        as (code, day, count) arrays, with users and conversations the codes refer to.
+        """
+        columns = Query.get_columns(
+            data,
+            rows=Query.select_rows(
+                data, kwargs.get("row_index"), conversation_ids=kwargs.get("shard")
+            ),
+            shared=kwargs.get("columns"),
+        )
+
+        rows = np.flatnonzero(~columns["is_meta"])
+        day = Query.to_local(columns["timestamp"][rows]) // Query.DAY
+        result = {
+            "users": columns["users"],
+            "conversations": columns["conversations"],
+        }
+        for name in ("user", "conversation"):
+            packed, ranges = Query.pack_keys(columns[name][rows], day)
+            assert packed is not None, "Too many days of running totals."
+            packed, counts = np.unique(packed, return_counts=True)
+            result[name] = (*Query.unpack_keys(packed, ranges), counts)
+        return result
+
+    def merge(
+        self, partials: List[Dict[str, Any]], data: List[tuple], **kwargs
+    ) -> Dict[str, pd.DataFrame]:
+        users = self.get_from_kw(kwargs, "users_map", None)
+        groups = self.get_from_kw(kwargs, "groups", None)
+        faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        # codes of all shards refer to the same (shared) users and conversations
+        columns = {
+            "users": partials[0]["users"],
+            "conversations": partials[0]["conversations"],
+        }
+        for name in ("user", "conversation"):
+            columns[name] = [
+                np.concatenate(arrays)
+                for arrays in zip(*(partial[name] for partial in partials))
+            ]
+
+        # every message is counted by its user
+        grid = RunningTotalsQuery.get_grid(columns["user"][1] * Query.DAY)
+        dates = Query.format_dates(grid.astype("datetime64[ms]"), "%Y-%m-%d")
+
+        # message counts to totals at grid dates from its bin on
+        user, day, counts = columns["user"]
+        user, date, totals = RunningTotalsQuery.get_totals(
+            user,
+            np.searchsorted(grid, day * Query.DAY, side="right"),
+            len(grid),
+            counts,
+        )
+        encoded_users = [
+            encode_user(user_id, users, faked_users=faked_users)
+            for user_id in columns["users"]
+        ]
+        users_result = pd.DataFrame(
+            [
+                [dates[d], columns["users"][u], *encoded_users[u]]
+                for d, u in zip(date.tolist(), user.tolist())
+            ],
+            columns=["date", "user_id", "name", "gender"],
+        )
+        users_result["messages"] = totals
+
+        conversation, day, counts = columns["conversation"]
+        conversation, date, totals = RunningTotalsQuery.get_totals(
+            conversation,
+            np.searchsorted(grid, day * Query.DAY, side="right"),
+            len(grid),
+            counts,
+        )
+        encoded_groups = [
+            [
+                *encode_group(conversation_id, groups),
+                ", ".join(
+                    sorted(
+                        encode_user(user_id, users, faked_users=faked_users)[0]
+                        for user_id in groups.get(conversation_id, [])
+                        if user_id != Config.get("user_id")
+                    )
+                ),
             ]
-            + [f"min_messages_is_{num}" for num in self.min_messages_num],
+            for conversation_id in columns["conversations"]
+        ]
+        conversations_result = pd.DataFrame(
+            [
+                [dates[d], columns["conversations"][c], *encoded_groups[c]]
+                for d, c in zip(date.tolist(), conversation.tolist())
+            ],
+            columns=[
+                "date",
+                "conversation_id",
+                "is_group",
+                "participants_num",
+                "names",
+            ],
+        )
+        conversations_result["messages"] = totals
+
+        return {"users": users_result, "conversations": conversations_result}
+
+    @staticmethod
+    def get_totals(
+        key: np.ndarray,
+        bins: np.ndarray,
+        grid_size: int,
+        counts: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Running totals of messages of each key at grid dates (bins are indexes of
+        first dates counting each message, counts - numbers of messages of each
+        entry, by default 1) - key, date and total of each nonzero total, sorted by
+        date and key.
+        """
+        keys, inverse = np.unique(
+            key.astype(np.int64) * (grid_size + 1) + bins, return_inverse=True
         )
+        counts = np.bincount(
+            inverse.reshape(-1), weights=counts, minlength=len(keys)
+        ).astype(np.int64)
+        key, bins = np.divmod(keys, grid_size + 1)
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        totals = np.cumsum(counts)
+        totals -= np.repeat(
+            totals[starts] - counts[starts], np.diff(np.r_[starts, len(key)])
+        )
+
+        # each total holds until the next bin of its key or the end of grid
+        ends = np.r_[bins[1:], grid_size]
+        ends[starts[1:] - 1] = grid_size
+        repeats = ends - bins
+        date = np.arange(repeats.sum()) + np.repeat(
+            bins - (np.cumsum(repeats) - repeats), repeats
+        )
+        key, totals = np.repeat(key, repeats), np.repeat(totals, repeats)
+        order = np.lexsort((key, date))
+        return key[order], date[order], totals[order]
+
+    @staticmethod
+    def get_grid(local: np.ndarray) -> np.ndarray:
+        """Wall clock milliseconds of grid dates, by default spanning local timestamps."""
+        step = np.timedelta64(Config.get("grid_days", 14), "D")
+        since, until = Config.get("grid_since", ""), Config.get("grid_until", "")
+        days = local.astype("datetime64[ms]").astype("datetime64[D]")
+        if len(days) == 0 and not (since and until):
+            return np.empty(0, dtype=np.int64)
+
+        first = np.datetime64(since, "D") if since else days.min()
+        # by default the last date comes after all messages
+        end = np.datetime64(until, "D") + 1 if until else days.max() + 1 + step
+        return np.arange(first, end, step).astype("datetime64[ms]").astype(np.int64)
 
 
 class MostCommonStrings(Query):
     """
-    Returning most common sequences of --words_count (default 2) words.
-    Data frame has columns:
+    Returning most common sequences of --words_count (default 1, 2 and 3) words,
+    all lengths are counted at once on token ids. Data frame of each length n
+    (saved to prefix_query_most_common_strings_n.csv) has columns:
     user - user --user_id, that send this,
     sequence of strings and count
+    With --top_k only k most common sequences of each user are kept, then
+    --ngram_counter sketch can count them approximately in bounded memory.
     """
 
+    # count-min sketch of --ngram_counter sketch
+    SKETCH_DEPTH = 4
+    SKETCH_WIDTH = 1 << 20
+    SKETCH_SEEDS = (
+        0x9E3779B97F4A7C15,
+        0xC2B2AE3D27D4EB4F,
+        0x165667B19E3779F9,
+        0xD6E8FEB86659FD93,
+    )
+    # number of sequences counted by sketch at once
+    CHUNK_SIZE = 1 << 20
+    CACHE_OPTIONS = Query.CACHE_OPTIONS + ("words_count", "top_k", "ngram_counter")
+
     def __init__(self) -> None:
         super().__init__(id="most_common_strings", result_extension=".csv")
 
-    def execute(self, data: List[tuple], **kwargs) -> Any:
+    def execute(self, data: List[tuple], **kwargs) -> Dict[int, pd.DataFrame]:
         users = self.get_from_kw(kwargs, "users_map", None)
-        how_many_words = Config.get("words_count")
         faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        top_k = Config.get("top_k")
+        counter = Config.get("ngram_counter")
+        assert counter in ("exact", "sketch"), f"Unknown n-gram counter: {counter}"
+        assert counter == "exact" or top_k > 0, "Sketch n-gram counter needs --top_k."
+
+        root_id = Config.get("user_id")
+        rows = Query.select_rows(
+            data,
+            kwargs.get("row_index"),
+            user_ids=None if root_id == "all" else [root_id],
+        )
+        columns = Query.get_columns(
+            data, tokens=True, rows=rows, shared=kwargs.get("columns")
+        )
+        selected = ~columns["is_meta"]
+
+        result = {}
+        for n in MostCommonStrings.get_words_counts():
+            if counter == "exact":
+                keys, counts = MostCommonStrings.count_exact(
+                    MostCommonStrings.get_sequences(columns, selected, n), top_k
+                )
+            else:
+                keys, counts = MostCommonStrings.count_sketch(
+                    MostCommonStrings.get_sequences(
+                        columns, selected, n, MostCommonStrings.CHUNK_SIZE
+                    ),
+                    top_k,
+                )
+            result[n] = MostCommonStrings.get_frame(
+                keys, counts, columns, users, faked_users
+            )
+        return result
 
-        conuts = {}
-        for line in data:
-            user_id, message = line[-3], line[-2]
+    def get_results(self) -> Tuple[int, ...]:
+        # results are named by lengths of counted sequences
+        return tuple(MostCommonStrings.get_words_counts())
 
-            if message == "MetaCommand" or (
-                Config.get("user_id") != "all" and user_id != Config.get("user_id")
-            ):
-                continue
+    @staticmethod
+    def get_words_counts() -> List[int]:
+        words_count = Config.get("words_count")
+        if isinstance(words_count, int):
+            words_count = [words_count]
+        words_count = sorted(set(int(n) for n in words_count))
+        assert all(n > 0 for n in words_count), "Words count must be positive."
+        return words_count
 
-            for i in range(len(message) - how_many_words + 1):
-                words_streak = " ".join(message[i : i + how_many_words])
-                key = (user_id, words_streak)
+    @staticmethod
+    def get_sequences(
+        columns: Dict[str, Any], selected: np.ndarray, n: int, chunk_size: int = None
+    ) -> Iterator[np.ndarray]:
+        """
+        Yields (user, token_1, ..., token_n) codes of n words sequences of selected
+        messages, in chunks of about chunk_size rows (all at once by default).
+        """
+        offsets = columns["token_offsets"]
+        lengths = np.diff(offsets)
+        messages = np.flatnonzero(selected & (lengths >= n))
+        counts = lengths[messages] - n + 1
+        ends = np.cumsum(counts)
 
-                if key in conuts.keys():
-                    conuts[key] += 1
-                else:
-                    conuts[key] = 1
+        first = 0
+        while first < len(messages):
+            done = ends[first - 1] if first > 0 else 0
+            last = len(messages)
+            if chunk_size is not None:
+                last = max(
+                    np.searchsorted(ends, done + chunk_size, side="right"), first + 1
+                )
 
-        df = pd.DataFrame(
-            [
-                encode(
-                    key[0],
-                    *encode_user(key[0], users, faked_users=faked_users),
-                    key[1],
-                    value,
+            chunk, chunk_counts = messages[first:last], counts[first:last]
+            starts = np.repeat(
+                offsets[chunk] - (np.cumsum(chunk_counts) - chunk_counts),
+                chunk_counts,
+            ) + np.arange(chunk_counts.sum())
+
+            keys = np.empty((len(starts), n + 1), dtype=np.int64)
+            keys[:, 0] = np.repeat(columns["user"][chunk], chunk_counts)
+            for j in range(n):
+                keys[:, j + 1] = columns["tokens"][starts + j]
+            yield keys
+            first = last
+
+    @staticmethod
+    def get_unique(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Distinct rows of keys and number of their occurrences."""
+        if len(keys) == 0:
+            return keys, np.zeros(0, dtype=np.int64)
+
+        # codes usually fit in a single int64
+        packed, _ = Query.pack_keys(*keys.T)
+        if packed is not None:
+            _, first, counts = np.unique(packed, return_index=True, return_counts=True)
+            return keys[first], counts
+
+        keys = keys[np.lexsort(keys.T[::-1])]
+        first = np.flatnonzero(
+            np.concatenate([[True], (keys[1:] != keys[:-1]).any(axis=1)])
+        )
+        return keys[first], np.diff(np.append(first, len(keys)))
+
+    @staticmethod
+    def get_top(
+        keys: np.ndarray, counts: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """top_k (all if 0) most common sequences of each user, most common first."""
+        if len(keys) == 0:
+            return keys, counts
+        order = np.lexsort((-counts, keys[:, 0]))
+        keys, counts = keys[order], counts[order]
+
+        if top_k > 0:
+            user_first = np.flatnonzero(
+                np.concatenate([[True], keys[1:, 0] != keys[:-1, 0]])
+            )
+            rank = np.arange(len(keys)) - np.repeat(
+                user_first, np.diff(np.append(user_first, len(keys)))
+            )
+            keys, counts = keys[rank < top_k], counts[rank < top_k]
+
+        order = np.argsort(-counts, kind="stable")
+        return keys[order], counts[order]
+
+    @staticmethod
+    def count_exact(
+        sequences: Iterator[np.ndarray], top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        keys = list(sequences)
+        if len(keys) == 0:
+            return np.zeros((0, 1), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return MostCommonStrings.get_top(
+            *MostCommonStrings.get_unique(np.concatenate(keys)), top_k
+        )
+
+    @staticmethod
+    def get_hashes(keys: np.ndarray) -> np.ndarray:
+        """Index of each row of keys in each row of sketch (multiply-shift hashing)."""
+        h = np.zeros(len(keys), dtype=np.uint64)
+        for j in range(keys.shape[1]):
+            h = (h ^ keys[:, j].astype(np.uint64)) * np.uint64(0x100000001B3)
+            h ^= h >> np.uint64(29)
+
+        shift = np.uint64(64 - (MostCommonStrings.SKETCH_WIDTH.bit_length() - 1))
+        return np.stack(
+            [(h * np.uint64(seed)) >> shift for seed in MostCommonStrings.SKETCH_SEEDS]
+        ).astype(np.int64)
+
+    @staticmethod
+    def count_sketch(
+        sequences: Iterator[np.ndarray], top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Counts sequences in count-min sketch, keeping only top_k candidates of each
+        user (heavy hitters) - counts are upper bounds of exact ones.
+        """
+        sketch = np.zeros(
+            (MostCommonStrings.SKETCH_DEPTH, MostCommonStrings.SKETCH_WIDTH),
+            dtype=np.int64,
+        )
+        rows = np.arange(MostCommonStrings.SKETCH_DEPTH)[:, None]
+
+        candidates = None
+        for keys in sequences:
+            hashes = MostCommonStrings.get_hashes(keys)
+            for d in range(MostCommonStrings.SKETCH_DEPTH):
+                sketch[d] += np.bincount(
+                    hashes[d], minlength=MostCommonStrings.SKETCH_WIDTH
                 )
-                for key, value in conuts.items()
-            ],
+
+            if candidates is not None:
+                keys = np.concatenate([candidates, keys])
+            keys, _ = MostCommonStrings.get_unique(keys)
+            estimates = sketch[rows, MostCommonStrings.get_hashes(keys)].min(axis=0)
+            candidates, _ = MostCommonStrings.get_top(keys, estimates, top_k)
+
+        if candidates is None:
+            return np.zeros((0, 1), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        estimates = sketch[rows, MostCommonStrings.get_hashes(candidates)].min(axis=0)
+        return MostCommonStrings.get_top(candidates, estimates, top_k)
+
+    @staticmethod
+    def get_frame(
+        keys: np.ndarray,
+        counts: np.ndarray,
+        columns: Dict[str, Any],
+        users: dict,
+        faked_users: dict,
+    ) -> pd.DataFrame:
+        vocabulary = np.asarray(columns["vocabulary"], dtype=object)
+        sequences = np.zeros(0, dtype=object)
+        if len(keys) > 0:
+            sequences = vocabulary[keys[:, 1]]
+        for j in range(2, keys.shape[1]):
+            sequences = sequences + " " + vocabulary[keys[:, j]]
+
+        user_ids = np.asarray(columns["users"], dtype=object)[keys[:, 0]]
+        encoded = {
+            user_id: encode_user(user_id, users, faked_users=faked_users)
+            for user_id in set(user_ids.tolist())
+        }
+
+        return pd.DataFrame(
+            {
+                "user_id": user_ids,
+                "name": [encoded[user_id][0] for user_id in user_ids.tolist()],
+                "gender": [encoded[user_id][1] for user_id in user_ids.tolist()],
+                "sequence_of_strings": sequences,
+                "count": counts,
+            },
             columns=["user_id", "name", "gender", "sequence_of_strings", "count"],
         )
-        df = df.sort_values("count", ascending=False)
-        return df
 
 
 class TimeToResponde(Query):
@@ -123,6 +703,7 @@ class TimeToResponde(Query):
     time_send - time that user sent last massege before response
     time_response - time that root sent first message on response
     delta_times - difference between last message sent to first response
+    delta_seconds - the same difference in seconds
     """
 
     def __init__(self) -> None:
@@ -135,79 +716,383 @@ class TimeToResponde(Query):
     def execute(self, data: List[tuple], **kwargs) -> Any:
         groups = self.get_from_kw(kwargs, "groups", None)
         faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        # both messages of response are needed, so users are filtered afterwards
+        columns = Query.get_columns(
+            data,
+            rows=Query.select_rows(data, kwargs.get("row_index"), users=False),
+            shared=kwargs.get("columns"),
+        )
+        send, user, timestamp = TimeToResponde.get_responses(columns, groups)
+        seconds = timestamp // 1000
+        delta_seconds = seconds[send + 1] - seconds[send]
 
-        data = [
-            [conversation_id, user_id, message, self.get_date(timestamp)]
-            for conversation_id, user_id, message, timestamp in data
-        ]
-        data.sort(
-            key=lambda line: (
-                line[0],
-                line[3],
-            )
+        # same as str(timedelta) for deltas shorter than a day
+        deltas, inverse = np.unique(delta_seconds, return_inverse=True)
+        deltas = np.array(
+            [f"{d // 3600}:{d % 3600 // 60:02d}:{d % 60:02d}" for d in deltas.tolist()],
+            dtype=object,
+        )
+        names = np.array(
+            [faked_users.get(user_id, "unknown") for user_id in columns["users"]],
+            dtype=object,
+        )
+        users = np.array(columns["users"], dtype=object)
+
+        return pd.DataFrame(
+            {
+                "responded_to_id": users[user[send]],
+                "responded_by_id": users[user[send + 1]],
+                "responded_to_name": names[user[send]],
+                "responded_by_name": names[user[send + 1]],
+                "time_send": Query.get_dates(
+                    timestamp[send], self.timestamp_group_format
+                ),
+                "time_responded": Query.get_dates(
+                    timestamp[send + 1], self.timestamp_group_format
+                ),
+                "delta": deltas[inverse],
+                "delta_seconds": delta_seconds,
+            }
+        )
+
+    @staticmethod
+    def get_responses(
+        columns: Dict[str, Any], groups: dict
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Messages of private conversations sorted by conversation and time - user and
+        timestamp of each, and indexes i of messages responded by message i + 1.
+        """
+        users = columns["users"]
+
+        # only messages of private conversations are taken into account,
+        # sorted by conversation id and time
+        is_group = np.array(
+            [len(groups.get(c, ())) > 2 for c in columns["conversations"]], dtype=bool
         )
+        rows = np.flatnonzero(~columns["is_meta"] & ~is_group[columns["conversation"]])
+        conversation = np.argsort(np.argsort(columns["conversations"]))
+        conversation = conversation[columns["conversation"]]
+        rows = rows[np.lexsort((columns["timestamp"][rows], conversation[rows]))]
+        conversation = conversation[rows]
+        user = columns["user"][rows]
+        timestamp = columns["timestamp"][rows]
 
-        last_user_id = None
-        last_time = None
-        df_dict = {}
+        # message i + 1 responds to message i if it was sent in the same conversation
+        # by another user - by root if it is not "all"
         root_id = Config.get("user_id")
-        for line in data:
-            conversation_id, user_id, messege, date = line[0], line[1], line[2], line[3]
-            if messege == "MetaCommand" or len(groups.get(conversation_id)) > 2:
-                continue
-
-            # we have previous message from not-root user
-            # or if user_id == "all" from another user
-            # and now user sent message - calculate time delta
-            if last_user_id is not None and (
-                (root_id == "all" and last_user_id != user_id) or user_id == root_id
-            ):
-                diff = datetime.strptime(date, "%Y-%m-%d %H:%M:%S") - datetime.strptime(
-                    last_time, "%Y-%m-%d %H:%M:%S"
+        responded = (conversation[1:] == conversation[:-1]) & (user[1:] != user[:-1])
+        if root_id != "all":
+            root = users.index(root_id) if root_id in users else -1
+            responded &= (user[1:] == root) & (user[:-1] != root)
+        user_ids = Query.get_predicates()["user_ids"]
+        if user_ids is not None:
+            responded &= np.isin(
+                user[1:], [users.index(u) for u in user_ids if u in users]
+            )
+
+        seconds = timestamp // 1000
+        delta_seconds = seconds[1:] - seconds[:-1]
+        responded &= (0 <= delta_seconds) & (delta_seconds < 24 * 60 * 60)
+        return np.flatnonzero(responded), user, timestamp
+
+
+class ResponseTimeSketch(TimeToResponde):
+    """
+    Aggregates of TimeToResponde responses not slower than --max_response_minutes,
+    computed without materializing them - per responder, weekday and 15 minutes
+    slot of message responded to (saved to prefix_query_response_time_sketch_slots.csv)
+    and per responder and 2 weeks bin (prefix_query_response_time_sketch_bins.csv,
+    bins start on the same dates as 2 weeks of CountMessagesRollup). Each row has
+    count, sum_seconds, mean_seconds, median_seconds, p90_seconds and sketch of
+    response times - counts of DDSketch buckets, so rows can be merged by adding
+    counts and sums. Results of earlier runs (e.g. on older messages, with --until)
+    given in --merge_response_sketches are merged into results.
+    """
+
+    # relative accuracy of quantiles - the same for all results, so they can be merged
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    QUANTILES = {"median_seconds": 0.5, "p90_seconds": 0.9}
+    WEEKDAYS = (
+        "Monday",
+        "Tuesday",
+        "Wednesday",
+        "Thursday",
+        "Friday",
+        "Saturday",
+        "Sunday",
+    )
+    RESULTS = ("slots", "bins")
+    SHARDED = True
+    # columns identifying rows of each result
+    KEYS = {
+        "slots": ["responded_by_id", "weekday", "slot"],
+        "bins": ["responded_by_id", "date"],
+    }
+    CACHE_OPTIONS = TimeToResponde.CACHE_OPTIONS + (
+        "max_response_minutes",
+        "merge_response_sketches",
+    )
+
+    def __init__(self) -> None:
+        Query.__init__(self, "response_time_sketch", ".csv")
+
+    def execute(self, data: List[tuple], **kwargs) -> Dict[str, pd.DataFrame]:
+        # merged from one partial result, not as responses of TimeToResponde
+        return Query.execute(self, data, **kwargs)
+
+    def execute_partial(self, data: List[tuple], **kwargs) -> Dict[str, pd.DataFrame]:
+        groups = self.get_from_kw(kwargs, "groups", None)
+        faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        columns = Query.get_columns(
+            data,
+            rows=Query.select_rows(
+                data,
+                kwargs.get("row_index"),
+                users=False,
+                conversation_ids=kwargs.get("shard"),
+            ),
+            shared=kwargs.get("columns"),
+        )
+        send, user, timestamp = TimeToResponde.get_responses(columns, groups)
+        delta_seconds = timestamp[send + 1] // 1000 - timestamp[send] // 1000
+        max_minutes = Config.get("max_response_minutes", 0)
+        if max_minutes > 0:
+            send = send[delta_seconds <= max_minutes * 60]
+            delta_seconds = delta_seconds[delta_seconds <= max_minutes * 60]
+        # responders are grouped in order of their ids, as in merged results
+        order = np.argsort(np.array(columns["users"], dtype=object))
+        user = np.argsort(order)[user[send + 1]]
+        local = Query.to_local(timestamp[send])
+
+        users = np.array(columns["users"], dtype=object)[order]
+        names = np.array(
+            [faked_users.get(user_id, "unknown") for user_id in users.tolist()],
+            dtype=object,
+        )
+        weekday = Query.get_buckets(local, "weekday", is_local=True)
+        slot = (
+            Query.get_buckets(local, "15min", is_local=True)
+            - Query.get_buckets(local, "day", is_local=True)
+        ).astype(np.int64) // Query.QUARTER
+        group, (user_code, weekday, slot) = ResponseTimeSketch.group(
+            user, weekday, slot
+        )
+        slots = pd.DataFrame(
+            {
+                "responded_by_id": users[user_code],
+                "responded_by_name": names[user_code],
+                "weekday": np.array(ResponseTimeSketch.WEEKDAYS, dtype=object)[weekday],
+                "slot": Query.format_dates(
+                    (slot * Query.QUARTER).astype("datetime64[ms]"), "%H:%M"
+                ),
+            }
+        )
+        slots = ResponseTimeSketch.get_frame(
+            slots, *ResponseTimeSketch.sketch(group, delta_seconds, len(slots))
+        )
+
+        # bins are grouped by their first day, as 2week level of rollup
+        group, (user_code, bins) = ResponseTimeSketch.group(
+            user,
+            Query.get_buckets(local, "2week", is_local=True)
+            .astype("datetime64[D]")
+            .astype(np.int64),
+        )
+        bins = pd.DataFrame(
+            {
+                "responded_by_id": users[user_code],
+                "responded_by_name": names[user_code],
+                "date": Query.format_dates(
+                    bins.astype("datetime64[D]").astype("datetime64[ms]"),
+                    CountMessagesRollup.LEVELS["2week"],
+                ),
+            }
+        )
+        bins = ResponseTimeSketch.get_frame(
+            bins, *ResponseTimeSketch.sketch(group, delta_seconds, len(bins))
+        )
+
+        return {"slots": slots, "bins": bins}
+
+    def merge(
+        self, partials: List[Dict[str, pd.DataFrame]], data: List[tuple], **kwargs
+    ) -> Dict[str, pd.DataFrame]:
+        result = partials[0]
+        if len(partials) > 1:
+            result = {
+                name: ResponseTimeSketch.merge_sketches(
+                    [partial[name] for partial in partials],
+                    ResponseTimeSketch.KEYS[name],
                 )
+                for name in self.RESULTS
+            }
+        for path in ResponseTimeSketch.get_merged_paths():
+            name = next(
+                (n for n in result if os.path.splitext(path)[0].endswith(f"_{n}")),
+                None,
+            )
+            assert name is not None, f"Not a result of {self.id} query: {path}"
+            logging.info(f"Query_{self.id}:Merging {path} into {name} results.")
+            result[name] = ResponseTimeSketch.merge_sketches(
+                [
+                    result[name],
+                    pd.read_csv(
+                        path, dtype={"responded_by_id": str}, keep_default_na=False
+                    ),
+                ],
+                ResponseTimeSketch.KEYS[name],
+            )
+        return result
+
+    def get_cache_key(self, fingerprint: str) -> str:
+        # merged results may change without changing options
+        return super().get_cache_key(
+            fingerprint
+            + ResultsCache.get_fingerprint(ResponseTimeSketch.get_merged_paths())
+        )
 
-                if 0 <= diff.days < 1:
-                    delta = str(diff)
-                    key = (last_user_id, user_id, last_time)
-                    df_dict[key] = (date, delta)
-                last_user_id = None
+    @staticmethod
+    def get_merged_paths() -> List[str]:
+        paths = Config.get("merge_response_sketches", "")
+        return [path for path in paths.split(",") if path != ""] if paths else []
 
-            if user_id != root_id:
-                last_user_id = user_id
-                last_time = date
+    @staticmethod
+    def group(*keys: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """Group of each row by keys, and keys of each group (sorted by keys)."""
+        packed, ranges = Query.pack_keys(*keys)
+        assert packed is not None, "Too many groups of response time sketch."
+        unique, group = np.unique(packed, return_inverse=True)
+        return group.reshape(-1), Query.unpack_keys(unique, ranges)
+
+    @staticmethod
+    def sketch(
+        group: np.ndarray, values: np.ndarray, groups_num: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Count and sum of values of each group, and its sketch as (group, bucket,
+        count) of nonempty buckets, sorted by group and bucket. Value x > 0 falls
+        into bucket ceil(log_gamma(x)), zeros into bucket -1.
+        """
+        counts = np.bincount(group, minlength=groups_num)
+        sums = np.bincount(group, weights=values, minlength=groups_num)
+        buckets = np.full(len(values), -1, dtype=np.int64)
+        positive = values > 0
+        buckets[positive] = np.ceil(
+            np.log(values[positive]) / np.log(ResponseTimeSketch.GAMMA)
+        )
+        # buckets are few, so they fit next to group in one int64
+        keys, bucket_counts = np.unique(
+            group.astype(np.int64) * (1 << 32) + buckets + 1, return_counts=True
+        )
+        bucket_group, bucket = np.divmod(keys, 1 << 32)
+        return counts, sums, bucket_group, bucket - 1, bucket_counts
 
-        # create data frame with user_id(sender not root), time_send, time_responde, delta times
-        df = pd.DataFrame(
+    @staticmethod
+    def get_quantile(
+        counts: np.ndarray,
+        bucket: np.ndarray,
+        bucket_counts: np.ndarray,
+        q: float,
+    ) -> np.ndarray:
+        """
+        q-quantile of each (nonempty) group of sketch() - value of bucket of its item
+        of rank floor(q * (count - 1)), within RELATIVE_ACCURACY of the exact one.
+        """
+        cumulative = np.cumsum(bucket_counts)
+        before = np.cumsum(counts) - counts
+        ranks = before + np.floor(q * (counts - 1)).astype(np.int64)
+        found = np.minimum(
+            np.searchsorted(cumulative, ranks, side="right"), len(bucket) - 1
+        )
+        gamma = ResponseTimeSketch.GAMMA
+        return np.where(
+            bucket[found] < 0,
+            0.0,
+            2 * gamma ** bucket[found].astype(float) / (gamma + 1),
+        )
+
+    @staticmethod
+    def get_frame(
+        df: pd.DataFrame,
+        counts: np.ndarray,
+        sums: np.ndarray,
+        bucket_group: np.ndarray,
+        bucket: np.ndarray,
+        bucket_counts: np.ndarray,
+    ) -> pd.DataFrame:
+        """Adds aggregates of sketches of rows of df, sketches as "bucket:count" lists."""
+        df["count"] = counts
+        df["sum_seconds"] = sums.astype(np.int64)
+        df["mean_seconds"] = np.round(sums / np.maximum(counts, 1), 2)
+        for column, q in ResponseTimeSketch.QUANTILES.items():
+            df[column] = np.round(
+                ResponseTimeSketch.get_quantile(counts, bucket, bucket_counts, q),
+                2,
+            )
+
+        # the same few items repeat in many sketches, so each is formatted once
+        pairs, inverse = np.unique(
+            bucket_counts * (1 << 32) + bucket + 1, return_inverse=True
+        )
+        counts_of_pairs, buckets_of_pairs = np.divmod(pairs, 1 << 32)
+        items = np.array(
             [
-                (
-                    key[0],
-                    key[1],
-                    faked_users[key[0]],
-                    faked_users[key[1]],
-                    key[2],
-                    value[0],
-                    value[1],
-                )
-                for key, value in df_dict.items()
-            ],
-            columns=[
-                "responded_to_id",
-                "responded_by_id",
-                "responded_to_name",
-                "responded_by_name",
-                "time_send",
-                "time_responded",
-                "delta",
+                f"{b - 1}:{c}"
+                for b, c in zip(buckets_of_pairs.tolist(), counts_of_pairs.tolist())
             ],
+            dtype=object,
         )
-
+        items = items[inverse.reshape(-1)].tolist()
+        starts = np.r_[0, np.cumsum(np.bincount(bucket_group, minlength=len(df)))]
+        df["sketch"] = [
+            " ".join(items[start:stop]) for start, stop in zip(starts[:-1], starts[1:])
+        ]
         return df
 
+    @staticmethod
+    def merge_sketches(frames: List[pd.DataFrame], keys: List[str]) -> pd.DataFrame:
+        """Merges rows with the same keys of results, by adding counts of sketches."""
+        df = pd.concat(frames, ignore_index=True)
+        if "weekday" in keys:
+            df["weekday"] = pd.Categorical(df["weekday"], ResponseTimeSketch.WEEKDAYS)
+        group = df.groupby(keys, sort=True).ngroup().to_numpy()
+        first = np.unique(group, return_index=True)[1]
+
+        # sketches of all rows are parsed at once to (bucket, count) items
+        sketches = df["sketch"].astype(str)
+        lengths = sketches.str.count(":").to_numpy()
+        items = np.fromstring(
+            " ".join(sketches.tolist()).replace(":", " "), dtype=np.int64, sep=" "
+        ).reshape(-1, 2)
+        bucket, bucket_counts = items[:, 0], items[:, 1]
+
+        item_group = np.repeat(group, lengths)
+        keys_num = int(group.max()) + 1 if len(group) > 0 else 0
+        packed, inverse = np.unique(
+            item_group.astype(np.int64) * (1 << 32) + bucket + 1, return_inverse=True
+        )
+        bucket_group, bucket = np.divmod(packed, 1 << 32)
+        return ResponseTimeSketch.get_frame(
+            df.iloc[first][[*keys[:1], "responded_by_name", *keys[1:]]].reset_index(
+                drop=True
+            ),
+            np.bincount(group, weights=df["count"], minlength=keys_num).astype(
+                np.int64
+            ),
+            np.bincount(group, weights=df["sum_seconds"], minlength=keys_num),
+            bucket_group,
+            bucket - 1,
+            np.bincount(inverse.reshape(-1), weights=bucket_counts).astype(np.int64),
+        )
+
 
 class MostCommonEmoji(Query):
     """
     Creates a data frame that each entry besides common informations
     have emoji and (if exists) word before and after this emoji.
+    Emojis are read from prefix_emoji_index written by cleaning.
     """
 
     def __init__(self) -> None:
@@ -217,33 +1102,72 @@ class MostCommonEmoji(Query):
         users = self.get_from_kw(kwargs, "users_map", None)
         groups = self.get_from_kw(kwargs, "groups", None)
         faked_users = self.get_from_kw(kwargs, "faked_users", None)
+        index = kwargs.get("emoji_index")
+        assert (
+            index is not None
+        ), "Emoji index not found (prefix_emoji_index is written by preprocessing)."
+        root_id = Config.get("user_id")
+        rows = Query.select_rows(
+            data,
+            kwargs.get("row_index"),
+            user_ids=None if root_id == "all" else [root_id],
+        )
+        columns = Query.get_columns(data, rows=rows, shared=kwargs.get("columns"))
 
-        emojis = []
-        for conversation_id, user_id, message, timestamp in data:
-            if message == "MetaCommand" or (
-                Config.get("user_id") != "all" and user_id != Config.get("user_id")
-            ):
-                continue
-
-            date = self.get_date(timestamp)
-            for i in range(len(message)):
-                if emoji.is_emoji(message[i]):
-                    word_behind = "" if i == 0 else message[i - 1]
-                    word_next = "" if i + 1 == len(message) else message[i + 1]
-                    emojis.append(
-                        encode(
-                            user_id,
-                            *encode_user(user_id, users, faked_users=faked_users),
-                            encode_group(conversation_id, groups)[0],
-                            date,
-                            message[i],
-                            word_behind,
-                            word_next,
-                        )
-                    )
+        messages = np.asarray(index.message)
+        assert len(messages) == 0 or messages[-1] < len(
+            data
+        ), "Emoji index doesn't match data, run preprocessing again."
 
-        df = pd.DataFrame(
-            emojis,
+        # emojis of selected rows - both are sorted, so they are binary searched
+        entries, local = slice(None), messages
+        if rows is not None:
+            first, last = (
+                np.searchsorted(messages, [rows[0], rows[-1] + 1])
+                if len(rows) > 0
+                else (0, 0)
+            )
+            local = np.searchsorted(rows, messages[first:last])
+            found = rows[np.minimum(local, len(rows) - 1)] == messages[first:last]
+            entries, local = first + np.flatnonzero(found), local[found]
+
+        entries = np.arange(len(index))[entries]
+        messages, user = messages[entries], columns["user"][local]
+        positions = np.asarray(index.position)[entries].astype(np.int64)
+        spans = np.asarray(index.span)[entries]
+        emojis = np.asarray(index.emojis, dtype=object)
+        # neighbour emoji is taken whole, not the token of it next to the span
+        behind, after = index.get_neighbours(entries)
+        word_behind = np.asarray(
+            MostCommonEmoji.get_words(data, messages, positions - 1), dtype=object
+        )
+        word_behind[behind >= 0] = emojis[behind[behind >= 0]]
+        word_next = np.asarray(
+            MostCommonEmoji.get_words(data, messages, positions + spans), dtype=object
+        )
+        word_next[after >= 0] = emojis[after[after >= 0]]
+
+        encoded = [
+            encode_user(user_id, users, faked_users=faked_users)
+            for user_id in columns["users"]
+        ]
+        is_group = np.array(
+            [encode_group(c, groups)[0] for c in columns["conversations"]], dtype=bool
+        )
+
+        return pd.DataFrame(
+            {
+                "user_id": np.asarray(columns["users"], dtype=object)[user],
+                "name": [encoded[u][0] for u in user.tolist()],
+                "gender": [encoded[u][1] for u in user.tolist()],
+                "is_group": is_group[columns["conversation"][local]],
+                "date": Query.get_dates(
+                    columns["timestamp"][local], self.timestamp_group_format
+                ),
+                "emoji": emojis[np.asarray(index.emoji)[entries]],
+                "word_behind": word_behind,
+                "word_next": word_next,
+            },
             columns=[
                 "user_id",
                 "name",
@@ -255,4 +1179,24 @@ class MostCommonEmoji(Query):
                 "word_next",
             ],
         )
-        return df
+
+    @staticmethod
+    def get_words(
+        data: List[tuple], messages: np.ndarray, positions: np.ndarray
+    ) -> List[str]:
+        """Words at given positions of messages, "" if position is out of message."""
+        if hasattr(data, "tokens"):  # columnar corpus
+            offsets = np.asarray(data.token_offsets)
+            starts = offsets[messages]
+            inside = (0 <= positions) & (positions < offsets[messages + 1] - starts)
+            words = np.full(len(messages), "", dtype=object)
+            words[inside] = np.asarray(data.vocabulary, dtype=object)[
+                np.asarray(data.tokens)[starts[inside] + positions[inside]]
+            ]
+            return words.tolist()
+
+        words = []
+        for message, position in zip(messages.tolist(), positions.tolist()):
+            tokens = data[message][-2]
+            words.append(tokens[position] if 0 <= position < len(tokens) else "")
+        return words
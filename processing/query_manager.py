@@ -1,9 +1,16 @@
 import os
-import logging
+import time
 import json
+import logging
+import multiprocessing
+import numpy as np
+
+from typing import Any, Callable, Dict, List, Tuple
 
-from faker import Faker
-from typing import List, Any
+try:  # faster json parser, standard json is used without it
+    import orjson
+except ImportError:
+    orjson = None
 
 from setup import Config
 from queries import (
@@ -11,20 +18,33 @@ from queries import (
     MostCommonStrings,
     TimeToResponde,
     MostCommonEmoji,
+    CountMessagesRollup,
+    RunningTotalsQuery,
+    ResponseTimeSketch,
 )
-from helpers import Query
+from helpers import DataColumns, Query, ResultsCache
+from corpus import Corpus, EmojiIndex, RowIndex
 from cleaning import CleaningExecutor
 
-
 QUERIES = (
     CountMessagesQuery(),
     MostCommonStrings(),
     TimeToResponde(),
     MostCommonEmoji(),
+    CountMessagesRollup(),
+    RunningTotalsQuery(),
+    ResponseTimeSketch(),
 )
 
 
 class QueryExecutor:
+    # data and query arguments of pool worker process
+    WORKER = {}
+    # rows of prefix_conversations.json checked by default
+    CHECK_SAMPLE_SIZE = 1000
+    # shards of conversations of sharded queries per pool process
+    SHARDS_PER_PROCESS = 4
+
     def __init__(
         self,
         data_file_path: str = None,
@@ -39,30 +59,155 @@ class QueryExecutor:
             QueryExecutor.get_conversations_ids_file_path(conversations_ids_file_path)
         )
 
-        self.data = QueryExecutor.load(self.data_file_path)
-        self.kwargs = {
-            "users_map": QueryExecutor.load(self.users_ids_file_path),
-            "conversations_map": QueryExecutor.load(self.conversations_ids_file_path),
-            "faked_users": MyFaker.get_fake_names(),
-        }
+        self.timings = {}
+        if Config.get("corpus_format") == "json":
+            self.data = self.timed(
+                "parse", lambda: QueryExecutor.load(self.data_file_path)
+            )
+            self.timed("check", lambda: QueryExecutor.check_data(self.data))
+        else:
+            # columns are memory mapped and checked when opened
+            self.data = self.timed(
+                "parse", lambda: Corpus(QueryExecutor.get_corpus_path(data_file_path))
+            )
+
+        self.kwargs = self.timed(
+            "maps",
+            lambda: {
+                "users_map": QueryExecutor.load(self.users_ids_file_path),
+                "conversations_map": QueryExecutor.load(
+                    self.conversations_ids_file_path
+                ),
+            },
+        )
+        self.kwargs["faked_users"] = self.timed("faker", MyFaker.get_fake_names)
+
+        emoji_index_path = QueryExecutor.get_emoji_index_path()
+        if os.path.isdir(emoji_index_path):
+            self.kwargs["emoji_index"] = self.timed(
+                "emoji_index", lambda: EmojiIndex(emoji_index_path)
+            )
+
+        self.timed(
+            "cache",
+            lambda: self.init_results_cache(
+                [
+                    (
+                        self.data.path
+                        if isinstance(self.data, Corpus)
+                        else self.data_file_path
+                    ),
+                    self.users_ids_file_path,
+                    self.conversations_ids_file_path,
+                    QueryExecutor.get_path(None, "users_faked"),
+                    emoji_index_path,
+                ]
+            ),
+        )
 
-        # check if it is exacly data format we expect, ie produced by our cleaner:
-        assert isinstance(
-            self.data, list
-        ), "Wrong data format (check expected format produced by CleaningExecutor)"
-        for l in self.data:
-            assert (
-                len(l) >= 3 and isinstance(l[-2], list | str) and isinstance(l[-1], int)
-            ), "Wrong data format (check expected format produced by CleaningExecutor)"
         assert isinstance(self.kwargs["users_map"], dict), "Users map should be dict."
         assert isinstance(
             self.kwargs["conversations_map"], dict
         ), "Conversations map should be dict."
 
-        self.pre_calculate()
+        # columns are read from data once, on first use, and shared by groups, rows
+        # index and all queries
+        self.kwargs["columns"] = DataColumns(self.data)
+        self.timed("groups", self.pre_calculate)
+        self.kwargs["row_index"] = self.timed("row_index", self.load_row_index)
+        logging.info(
+            "Data loaded, took "
+            + ", ".join(f"{phase} {t:.2f}s" for phase, t in self.timings.items())
+        )
+
+    def timed(self, phase: str, load: Callable[[], Any]) -> Any:
+        """Calls load, its time is reported as phase of loading data."""
+        start = time.time()
+        result = load()
+        self.timings[phase] = time.time() - start
+        return result
+
+    @staticmethod
+    def check_data(data: List[tuple]) -> None:
+        """
+        Checks if it is exacly data format we expect, ie produced by our cleaner - by
+        default on a sample of rows (first, last and random ones), all rows with
+        --data_check full.
+        """
+        assert isinstance(
+            data, list
+        ), "Wrong data format (check expected format produced by CleaningExecutor)"
+
+        rows = data
+        if Config.get("data_check") != "full" and len(data) > 0:
+            sample = np.random.default_rng(0).integers(
+                len(data), size=QueryExecutor.CHECK_SAMPLE_SIZE
+            )
+            rows = [data[i] for i in [0, len(data) - 1, *sample.tolist()]]
+
+        for l in rows:
+            assert (
+                isinstance(l, list)
+                and len(l) >= 3
+                and isinstance(l[-2], list | str)
+                and isinstance(l[-1], int)
+            ), "Wrong data format (check expected format produced by CleaningExecutor)"
+
+    def init_results_cache(self, paths: List[str]) -> None:
+        """Opens results cache, keyed by fingerprint of query input files."""
+        path = QueryExecutor.get_results_cache_path()
+        if Config.get("clear_query_cache") == 1 and os.path.exists(path):
+            logging.info(f"Removing cached query results ({path})")
+            ResultsCache(path, 0, "").clear()
+
+        if Config.get("query_cache_size") > 0:
+            self.kwargs["results_cache"] = ResultsCache(
+                path,
+                Config.get("query_cache_size") << 20,
+                ResultsCache.get_fingerprint(paths),
+            )
+
+    def is_up_to_date(self, path: str) -> bool:
+        """Whether file at path exists and was written after data."""
+        data_path = (
+            os.path.join(self.data.path, "conversation.npy")
+            if isinstance(self.data, Corpus)
+            else self.data_file_path
+        )
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+            data_path
+        )
+
+    def load_row_index(self) -> RowIndex:
+        """Index of rows for queries predicates, built once per corpus."""
+        path = QueryExecutor.get_row_index_path()
+        if self.is_up_to_date(os.path.join(path, "by_time.npy")):
+            return RowIndex(path)
+
+        logging.info(f"Building rows index {path}")
+        columns = self.kwargs["columns"].get()
+        index = RowIndex.build(
+            columns["conversation"],
+            columns["user"],
+            columns["timestamp"],
+            columns["conversations"],
+            columns["users"],
+        )
+        index.write(path)
+        return index
 
     def pre_calculate(self):
-        self.kwargs["groups"] = Query.get_groups(self.data)
+        # groups written by cleaning are used unless data changed since then
+        groups_path = QueryExecutor.get_groups_file_path()
+        if self.is_up_to_date(groups_path):
+            self.kwargs["groups"] = {
+                conversation_id: set(users)
+                for conversation_id, users in QueryExecutor.load(groups_path).items()
+            }
+        elif isinstance(self.data, Corpus):
+            self.kwargs["groups"] = self.data.get_groups()
+        else:
+            self.kwargs["groups"] = self.kwargs["columns"].get_groups()
 
     def __call__(self, *args: List[int], **kwargs) -> None:
         """
@@ -78,14 +223,174 @@ class QueryExecutor:
 
         for q in args:
             assert 0 <= int(q) < len(QUERIES), f"Wrong query id provided (got {q})."
-            QUERIES[int(q)](
+        ids = [int(q) for q in args]
+
+        if Config.get("engine") == "processes":
+            self.execute_with_processes(ids, **kwargs)
+            return
+
+        for q in ids:
+            QUERIES[q](
                 self.data,
                 **self.kwargs,
                 **kwargs,
             )
 
+    def execute_with_processes(self, ids: List[int], **kwargs) -> None:
+        """
+        Queries run in pool workers - sharded queries on shards of conversations
+        (merged in this process), others whole. Workers get data without copying -
+        forked from this process or memory mapped from prefix_corpus directory.
+        """
+        cache = self.kwargs.get("results_cache")
+        if cache is not None:
+            ids = [q for q in ids if not cache.restore(QUERIES[q])]
+        if len(ids) == 0:
+            return
+
+        if not isinstance(self.data, Corpus):
+            # columns of json data are read before fork, so workers share them
+            self.kwargs["columns"].get()
+        shards = self.get_shards()
+
+        with QueryExecutor.get_context().Pool(
+            processes=Config.get("n_threads"),
+            initializer=QueryExecutor.init_worker,
+            initargs=(dict(Config.config.__dict__), *self.get_worker_args()),
+        ) as pool:
+            results = {
+                q: (
+                    [
+                        pool.apply_async(
+                            QueryExecutor.execute_partial, ((q, shard, kwargs),)
+                        )
+                        for shard in shards
+                    ]
+                    if QUERIES[q].SHARDED and len(shards) > 1
+                    else pool.apply_async(QueryExecutor.execute_query, ((q, kwargs),))
+                )
+                for q in ids
+            }
+            for q, result in results.items():
+                if not isinstance(result, list):
+                    result.get()
+                    continue
+
+                query = QUERIES[q]
+                partials = [partial.get() for partial in result]
+                logging.info(f"Query_{query.id}:Merging {len(partials)} shards.")
+                query.write(query.merge(partials, self.data, **self.kwargs, **kwargs))
+                if cache is not None:
+                    cache.store(query)
+
+    def get_shards(self) -> List[List[str]]:
+        """
+        Conversation ids of each shard of sharded queries - up to SHARDS_PER_PROCESS
+        shards per process of runs of conversations (in order of their first rows),
+        with similar numbers of rows. Conversations are written whole by cleaning,
+        so results of shards follow each other as in results of all data - if rows
+        of conversations are interleaved, queries are not sharded.
+        """
+        columns = self.kwargs["columns"].get()
+        codes, first, counts = np.unique(
+            columns["conversation"], return_index=True, return_counts=True
+        )
+        if np.count_nonzero(np.diff(columns["conversation"])) >= len(codes):
+            logging.info("Rows of conversations are interleaved, queries run whole.")
+            return [columns["conversations"]]
+        order = np.argsort(first)
+        ids = np.array(columns["conversations"], dtype=object)[codes[order]]
+        counts = counts[order]
+
+        selected = Query.get_predicates()["conversation_ids"]
+        if selected is not None:
+            selected = set(selected)
+            keep = np.array([i in selected for i in ids.tolist()], dtype=bool)
+            ids, counts = ids[keep], counts[keep]
+
+        shards_num = min(
+            len(ids), QueryExecutor.SHARDS_PER_PROCESS * Config.get("n_threads")
+        )
+        if shards_num <= 1:
+            return [ids.tolist()]
+        totals = np.cumsum(counts)
+        bounds = np.searchsorted(
+            totals, np.arange(1, shards_num) * totals[-1] / shards_num, side="right"
+        )
+        return [shard.tolist() for shard in np.split(ids, bounds) if len(shard) > 0]
+
+    @staticmethod
+    def get_context() -> multiprocessing.context.BaseContext:
+        """
+        Fork context, so workers share loaded data with this process instead of
+        getting a pickled copy. Where fork is not available (Windows) workers are
+        spawned - json data is then pickled to each of them, memory mapped
+        --corpus_format columnar data is not.
+        """
+        if "fork" in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context("fork")
+        if Config.get("corpus_format") == "json":
+            logging.warning(
+                "Fork is not available, data is copied to each query worker - "
+                "use --corpus_format columnar to share it."
+            )
+        return multiprocessing.get_context()
+
+    def get_worker_args(self) -> Tuple[List[tuple] | str, dict, Dict[str, str]]:
+        """
+        Data, query arguments and paths of memory mapped indexes of pool workers.
+        Memory mapped corpus and indexes are passed as paths and opened by each
+        worker, so they are never pickled.
+        """
+        kwargs = dict(self.kwargs)
+        paths = {
+            name: kwargs.pop(name).path
+            for name in ("row_index", "emoji_index")
+            if name in kwargs
+        }
+        if isinstance(self.data, Corpus):
+            kwargs.pop("columns")
+            return self.data.path, kwargs, paths
+        return self.data, kwargs, paths
+
+    @staticmethod
+    def init_worker(
+        config: dict, data: List[tuple] | str, kwargs: dict, paths: Dict[str, str]
+    ) -> None:
+        CleaningExecutor.init_worker(config)
+        if isinstance(data, str):
+            data = Corpus(data)
+            kwargs["columns"] = DataColumns(data)
+        if "row_index" in paths:
+            kwargs["row_index"] = RowIndex(paths["row_index"])
+        if "emoji_index" in paths:
+            kwargs["emoji_index"] = EmojiIndex(paths["emoji_index"])
+        QueryExecutor.WORKER.update(data=data, kwargs=kwargs)
+
+    @staticmethod
+    def execute_query(task: Tuple[int, dict]) -> None:
+        q, kwargs = task
+        QUERIES[q](
+            QueryExecutor.WORKER["data"],
+            **QueryExecutor.WORKER["kwargs"],
+            **kwargs,
+        )
+
+    @staticmethod
+    def execute_partial(task: Tuple[int, List[str], dict]) -> Any:
+        q, shard, kwargs = task
+        return QUERIES[q].execute_partial(
+            QueryExecutor.WORKER["data"],
+            **QueryExecutor.WORKER["kwargs"],
+            **kwargs,
+            shard=shard,
+        )
+
     @staticmethod
     def load(path: str) -> Any:
+        if orjson is not None:
+            with open(path, "rb") as file:
+                return orjson.loads(file.read())
         with open(path, "r", encoding="utf-8") as file:
             return json.load(file)
 
@@ -93,6 +398,10 @@ class QueryExecutor:
     def get_conversations_file_path(path: str) -> str:
         return QueryExecutor.get_path(path, "conversations")
 
+    @staticmethod
+    def get_groups_file_path(path: str = None) -> str:
+        return QueryExecutor.get_path(path, "groups")
+
     @staticmethod
     def get_users_ids_file_path(path: str) -> str:
         return QueryExecutor.get_path(path, "users_reversed")
@@ -102,7 +411,23 @@ class QueryExecutor:
         return QueryExecutor.get_path(path, "titles_reversed")
 
     @staticmethod
-    def get_path(path: str, name: str = None) -> str:
+    def get_corpus_path(path: str) -> str:
+        return QueryExecutor.get_path(path, "corpus", extension="")
+
+    @staticmethod
+    def get_results_cache_path() -> str:
+        return os.path.join(QueryExecutor.get_path(None), "query_cache.sqlite")
+
+    @staticmethod
+    def get_row_index_path(path: str = None) -> str:
+        return QueryExecutor.get_path(path, "row_index", extension="")
+
+    @staticmethod
+    def get_emoji_index_path(path: str = None) -> str:
+        return QueryExecutor.get_path(path, "emoji_index", extension="")
+
+    @staticmethod
+    def get_path(path: str, name: str = None, extension: str = ".json") -> str:
         if path is None:
             config_path = Config.get("output_dir_path")
             if config_path.startswith("/"):
@@ -115,7 +440,7 @@ class QueryExecutor:
             if name is not None:
                 path = os.path.join(
                     path,
-                    Config.get("prefix") + "_" + f"{name}.json",
+                    Config.get("prefix") + "_" + f"{name}{extension}",
                 )
 
         return path
@@ -130,17 +455,24 @@ class MyFaker:
     @staticmethod
     def get_fake_names(users_file_path: str = None) -> dict:
         faked_path = QueryExecutor.get_path(users_file_path, "users_faked")
-        if os.path.exists(faked_path):
-            logging.info("Faker:faked users are already generated")
-            return QueryExecutor.load(faked_path)
-
-        fake = Faker("pl_PL")
         path = QueryExecutor.get_path(users_file_path, "users")
         names = QueryExecutor.load(path)
 
+        # users added by incremental cleaning are faked, others keep their names
         fake_names = {}
-        taken_names = set()
+        if os.path.exists(faked_path):
+            fake_names = QueryExecutor.load(faked_path)
+            if all(user_id in fake_names for user_id, _ in names.values()):
+                logging.info("Faker:faked users are already generated")
+                return fake_names
+
+        from faker import Faker
+
+        fake = Faker("pl_PL")
+        taken_names = set(fake_names.values())
         for name, (user_id, gender) in names.items():
+            if user_id in fake_names:
+                continue
             if user_id == Config.get("user_id"):
                 fake_names[user_id] = name
                 taken_names.add(name)
@@ -153,6 +485,6 @@ class MyFaker:
             fake_names[user_id] = name
 
         CleaningExecutor.save_json(
-            fake_names, Config.get("prefix") + "_" + "users_faked.json"
+            fake_names, Config.get("prefix") + "_" + "users_faked.json", extend=False
         )
         return fake_names
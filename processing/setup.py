@@ -15,7 +15,7 @@ ARGUMENTS = (
     (
         "input_dir_path",
         os.path.join(os.path.dirname(__file__), "data"),
-        "Directory holding folders containing facebook data in json format.  Defaults to 'data' directory in setup's folder.",
+        "Directory holding folders containing facebook data in json format, or comma separated directories of several accounts exports cleaned into one corpus. Defaults to 'data' directory in setup's folder.",
         False,
         str,
     ),
@@ -29,7 +29,28 @@ ARGUMENTS = (
     (
         "n_threads",
         8,
-        "Number of threads to be used for processing. Defaults to 8.",
+        "Number of threads (or worker processes) to be used for processing. Defaults to 8.",
+        False,
+        int,
+    ),
+    (
+        "engine",
+        "threads",
+        "Cleaning and query engine - 'threads' (default) cleans with threads sharing one interpreter and runs queries in the main process, 'processes' cleans conversations and runs queries in a pool of --n_threads processes.",
+        False,
+        str,
+    ),
+    (
+        "batch_size",
+        256,
+        "Number of messages lemmatized by spaCy at once. Defaults to 256.",
+        False,
+        int,
+    ),
+    (
+        "cache_size",
+        5_000_000,
+        "Maximum number of cleaned messages kept in tokens cache (tokens_cache.sqlite in output directory) between runs, 0 disables cache. Defaults to 5000000.",
         False,
         int,
     ),
@@ -41,6 +62,118 @@ ARGUMENTS = (
         False,
         str,
     ),
+    (
+        "language_min_length",
+        20,
+        "Messages with fewer letters inherit language detected for their conversation. Defaults to 20.",
+        False,
+        int,
+    ),
+    (
+        "language_window",
+        0,
+        "If positive, language is detected once per that many consecutive messages (for mixed-language conversations) instead of once per conversation. Defaults to 0.",
+        False,
+        int,
+    ),
+    (
+        "corpus_format",
+        "json",
+        "Format of merged cleaned messages - 'json' (default) for prefix_conversations.json, 'columnar' for memory mapped prefix_corpus directory, 'both' to write both. Queries read corpus in that format.",
+        False,
+        str,
+    ),
+    (
+        "timezone",
+        "local",
+        "Timezone of dates in query results - 'local' (default) for system timezone or IANA name like 'Europe/Warsaw'.",
+        False,
+        str,
+    ),
+    (
+        "data_check",
+        "sample",
+        "How prefix_conversations.json rows are checked when loaded for queries - 'sample' (default) checks first, last and 1000 random rows, 'full' checks all of them.",
+        False,
+        str,
+    ),
+    (
+        "since",
+        "",
+        "Queries take only messages sent at or after this date (ISO format, e.g. 2020-10-01 or '2020-10-01 12:00', in --timezone). By default all of them.",
+        False,
+        str,
+    ),
+    (
+        "until",
+        "",
+        "Queries take only messages sent before this date (ISO format, in --timezone). By default all of them.",
+        False,
+        str,
+    ),
+    (
+        "user_ids",
+        "",
+        "Comma separated user_ids - queries take only messages sent by these users (TimeToResponde - responses of them). By default all users.",
+        False,
+        str,
+    ),
+    (
+        "conversation_ids",
+        "",
+        "Comma separated title_ids - queries take only messages of these conversations. By default all of them.",
+        False,
+        str,
+    ),
+    (
+        "grid_since",
+        "",
+        "First date of RunningTotalsQuery grid (ISO format, in --timezone). By default day of the first message.",
+        False,
+        str,
+    ),
+    (
+        "grid_until",
+        "",
+        "Last date of RunningTotalsQuery grid (ISO format, in --timezone). By default first grid date after the last message.",
+        False,
+        str,
+    ),
+    (
+        "grid_days",
+        14,
+        "Days between dates of RunningTotalsQuery grid. Defaults to 14.",
+        False,
+        int,
+    ),
+    (
+        "max_response_minutes",
+        720,
+        "Responses slower than this many minutes are left out of ResponseTimeSketch aggregates, 0 keeps all responses (up to a day). Defaults to 720.",
+        False,
+        int,
+    ),
+    (
+        "merge_response_sketches",
+        "",
+        "Comma separated paths of earlier ResponseTimeSketch results (prefix_query_response_time_sketch_slots.csv or _bins.csv files) merged into its results, e.g. results of older messages when only newer ones are selected with --since. By default nothing is merged.",
+        False,
+        str,
+    ),
+    (
+        "query_cache_size",
+        256,
+        "Maximum size (in MB) of query results cache (query_cache.sqlite in output directory) - queries ran again on unchanged data with the same options restore their results from it, 0 disables cache. Defaults to 256.",
+        False,
+        int,
+    ),
+    (
+        "clear_query_cache",
+        0,
+        "1 - remove all cached query results before executing queries, 0 (default) to keep them.",
+        False,
+        int,
+    ),
     (
         "verbose",
         0,
@@ -71,11 +204,25 @@ ARGUMENTS = (
     ),
     (
         "words_count",
-        2,
-        "How long a sequence of words we want to count for the query MostCommonStrings.",
+        [1, 2, 3],
+        "How long sequences of words we want to count for the query MostCommonStrings, one digit per length (e.g. 13 for 1 and 3). By default 1, 2 and 3 are counted at once.",
+        False,
+        list,
+    ),
+    (
+        "top_k",
+        0,
+        "Number of most common sequences of words kept for each user by MostCommonStrings. Defaults to 0 - all of them.",
         False,
         int,
     ),
+    (
+        "ngram_counter",
+        "exact",
+        "How MostCommonStrings counts sequences of words - 'exact' (default) or 'sketch' for approximate counts in bounded memory (count-min sketch, requires --top_k).",
+        False,
+        str,
+    ),
 )
 
 
@@ -0,0 +1,40 @@
+import os
+import sys
+import json
+import subprocess
+
+PROCESSING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# budget of importing query_manager, queries only mode should start fast
+IMPORT_SECONDS = 1.0
+
+IMPORT_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import query_manager
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "modules": [name for name in ("spacy", "faker") if name in sys.modules],
+}))
+"""
+
+
+def import_query_manager() -> dict:
+    """Imports query_manager in a fresh interpreter, returns its time and modules."""
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE],
+        cwd=PROCESSING_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_query_manager_does_not_load_spacy_or_faker():
+    assert import_query_manager()["modules"] == []
+
+
+def test_query_manager_import_time():
+    # best of a few runs, so a busy machine does not fail it
+    seconds = min(import_query_manager()["seconds"] for _ in range(3))
+    assert seconds < IMPORT_SECONDS, f"Importing query_manager took {seconds:.2f}s."